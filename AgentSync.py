@@ -0,0 +1,55 @@
+class AgentSync():
+    # Keeps the visible models of many AI characters on the terrain, each
+    # visual is parented to a proxy node that follows the position and
+    # heading of the plain NodePath its AICharacter drives, but not the
+    # pitch and roll the AI gives it on slopes, so no second Actor is
+    # needed and the visual stays level, only the height is corrected,
+    # for all agents with one batched HeightSampler query
+    # drivers are expected directly under the AIWorld's render node
+    def __init__(self, heightSampler = None):
+        self.heightSampler = heightSampler
+
+        self.drivers = []
+        self.visuals = []
+        # Heading only node of each driver at Z 0, a visual's Z
+        # under it is its height in the driver's parent
+        self.proxies = []
+
+    # Parent visual to the driver's proxy, keeping where the visual is in the world
+    def addAgent(self, driver, visual):
+        proxy = driver.getParent().attachNewNode(driver.getName() + "_proxy")
+        self.placeProxy(proxy, driver)
+        visual.wrtReparentTo(proxy)
+        self.drivers.append(driver)
+        self.visuals.append(visual)
+        self.proxies.append(proxy)
+
+    def removeAgent(self, driver):
+        i = self.drivers.index(driver)
+        self.visuals[i].wrtReparentTo(driver.getParent())
+        self.proxies[i].removeNode()
+        del self.drivers[i]
+        del self.visuals[i]
+        del self.proxies[i]
+
+    def placeProxy(self, proxy, driver):
+        pos = driver.getPos()
+        proxy.setPosHpr(pos.x, pos.y, 0, driver.getH(), 0, 0)
+
+    # Move every visual with its driver and onto the terrain under it,
+    # visuals off the terrain or without a height sampler keep their
+    # last height, call once per frame
+    def update(self):
+        for proxy, driver in zip(self.proxies, self.drivers):
+            self.placeProxy(proxy, driver)
+
+        if self.heightSampler == None or len(self.drivers) == 0:
+            return
+
+        positions = [driver.getPos() for driver in self.drivers]
+        heights = self.heightSampler.heightsAt([pos.x for pos in positions], [pos.y for pos in positions]).tolist()
+
+        for visual, height in zip(self.visuals, heights):
+            # NaN is off the terrain
+            if height == height:
+                visual.setZ(height)
@@ -1,53 +1,253 @@
 from panda3d.core import Point3D, deg2Rad, NodePath, Filename, CSZupRight
-from panda3d.core import CollisionNode,CollisionPolygon, GeomVertexFormat, Point3
+from panda3d.core import CollisionNode,CollisionPolygon, GeomVertexFormat, Point3, Geom
+from panda3d.core import VirtualFileSystem, getModelPath, GeomVertexData, GeomTriangles, GeomNode
 from panda3d.egg import EggPolygon, EggGroup, EggVertexPool, EggData, EggVertex, loadEggData, EggCoordinateSystem
+from array import array
 import math
+import hashlib
+import os
 
+# NumPy is optional, the collision mesh is built one triangle
+# at a time and no HeightSampler is made without it
+try:
+    import numpy
+    from HeightSampler import HeightSampler
+except ImportError:
+    numpy = None
 
-def makeCollisionModel(inputModel = "models/arena_1.bam", modelOffset = 0):
+# Triangles per CollisionNode made by makeCollisionModel, nearby
+# triangles share a node so its bounds let the traverser skip it
+COLLISION_BATCH = 1024
+
+# Triangles with a smaller area are degenerate and left out
+DEGENERATE_AREA = 1e-8
+
+# Tagged on baked collision side-files, bump when makeCollisionMeshes
+# output changes so the old side-files are rebuilt
+COLLISION_CACHE_FORMAT = "collision 1"
+
+
+def makeCollisionModel(inputModel = "models/arena_1.bam", modelOffset = 0, useCache = True, heightNodeName = None):
     # we can utilize a collision mesh generated directly for the built-in collision system
     # to obtain a varying heightfield, adapted from:
     # https://discourse.panda3d.org/t/collision-mesh-from-loaded-model-for-built-in-collision-system/27102
+    # with heightNodeName the terrain GeomNodes of that name are also hashed into
+    # a HeightSampler, kept as the "heightSampler" python tag of the returned root
     # load model
     path_to_model = inputModel
     model_root = base.loader.loadModel(path_to_model)
     model_root.reparentTo(base.render)
+    if numpy == None:
+        heightNodeName = None
+
+    # the baked collision tree is kept in a <model>_collision.bam side-file,
+    # the height sampler in <model>_height.npz, both reused as long as the
+    # model is unchanged
+    source_path = resolveModelPath(path_to_model)
+    collision_root = None
+    height_sampler = None
+    if useCache and not(source_path == None):
+        cache_path = os.path.splitext(source_path)[0] + "_collision.bam"
+        height_path = os.path.splitext(source_path)[0] + "_height.npz"
+        collision_root = loadCollisionCache(source_path, cache_path)
+        if not(collision_root == None or heightNodeName == None):
+            height_sampler = loadHeightCache(height_path, collision_root.getTag("sourceHash"), heightNodeName)
+            if height_sampler == None:
+                collision_root = None
+
+    if collision_root == None:
+        # create a temporary copy to generate the collision meshes from
+        model_copy = model_root.copyTo(base.render)
+        model_copy.detachNode()
+        # "bake" the transformations into the vertices
+        model_copy.flattenLight()
+
+        # create root node to attach collision nodes to
+        collision_root = NodePath("collision_root")
+        terrain = makeCollisionMeshes(model_copy, collision_root, heightNodeName)
+        if not(heightNodeName == None):
+            height_sampler = HeightSampler.fromTriangles(numpy.concatenate(terrain) if len(terrain) > 0 else [])
+
+        if useCache and not(source_path == None):
+            saveCollisionCache(collision_root, source_path, cache_path)
+            if not(height_sampler == None):
+                height_sampler.save(height_path, sourceHash = collision_root.getTag("sourceHash"), heightNode = heightNodeName)
 
-    # create a temporary copy to generate the collision meshes from
-    model_copy = model_root.copyTo(base.render)
-    model_copy.detachNode()
-    # "bake" the transformations into the vertices
-    model_copy.flattenLight()
-
-    # create root node to attach collision nodes to
-    collision_root = NodePath("collision_root")
     collision_root.reparentTo(model_root)
     # offset the collision meshes from the model so they're easier to see
     collision_root.setX(modelOffset)
     collision_root.setY(modelOffset)
 
-    # create a collision mesh for each of the loaded models
+    # no terrain node of that name, the caller keeps its own ground following
+    if not(height_sampler == None) and height_sampler.isEmpty():
+        height_sampler = None
+
+    if not(height_sampler == None):
+        height_sampler.translate(modelOffset, modelOffset)
+        collision_root.setPythonTag("heightSampler", height_sampler)
+
+    # model_root.hide()
+    return collision_root
+
+def resolveModelPath(inputModel):
+    # the file a model name loads from, found along the model path,
+    # None when it is not a plain file on disk
+    filename = Filename(inputModel)
+    if not VirtualFileSystem.getGlobalPtr().resolveFilename(filename, getModelPath().getValue()):
+        return None
+    path = filename.toOsSpecific()
+    if not os.path.isfile(path):
+        return None
+    return path
+
+def loadCollisionCache(source_path, cache_path):
+    # the collision tree baked from the model at source_path, None when the
+    # side-file is missing or was baked from a different version of it,
+    # an unchanged mtime is trusted, otherwise the content hash decides
+    if not os.path.isfile(cache_path):
+        return None
+    cached = base.loader.loadModel(Filename.fromOsSpecific(cache_path), noCache = True, okMissing = True)
+    if cached == None or not(cached.getTag("cacheFormat") == COLLISION_CACHE_FORMAT):
+        return None
+
+    if cached.getTag("sourceMtime") == str(os.path.getmtime(source_path)):
+        return cached
+    if cached.getTag("sourceHash") == fileHash(source_path):
+        return cached
+    print("Collision cache " + cache_path + " is out of date, rebuilding...")
+    return None
+
+def saveCollisionCache(collision_root, source_path, cache_path):
+    # write the baked collision tree next to the model, through a temporary
+    # file so a partial write is never loaded
+    collision_root.setTag("cacheFormat", COLLISION_CACHE_FORMAT)
+    collision_root.setTag("sourceMtime", str(os.path.getmtime(source_path)))
+    collision_root.setTag("sourceHash", fileHash(source_path))
+
+    temp_path = cache_path + ".tmp.bam"
+    if collision_root.writeBamFile(Filename.fromOsSpecific(temp_path)):
+        os.replace(temp_path, cache_path)
+    elif os.path.isfile(temp_path):
+        os.remove(temp_path)
+
+def loadHeightCache(height_path, source_hash, height_node):
+    # the saved height sampler when it was built from the same
+    # model version and terrain node, None otherwise
+    if not os.path.isfile(height_path):
+        return None
+    height_sampler, tags = HeightSampler.load(height_path)
+    if not(tags.get("sourceHash") == source_hash and tags.get("heightNode") == height_node):
+        return None
+    return height_sampler
+
+def fileHash(path):
+    # sha256 of a file's contents
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def makeCollisionMeshes(model_copy, collision_root, height_node = None):
+    # create a collision mesh for each of the loaded models, split into
+    # CollisionNodes of up to COLLISION_BATCH nearby triangles that all
+    # keep the name of the model they came from, returns the triangle
+    # corners of the models named height_node as (N, 3, 3) arrays
+    terrain = []
     for model in model_copy.findAllMatches("**/+GeomNode"):
         model_node = model.node()
-        collision_node = CollisionNode(model_node.name)
-        collision_mesh = collision_root.attachNewNode(collision_node)
-        # collision nodes are hidden by default
-        collision_mesh.show()
 
         for geom in model_node.modifyGeoms():
-            geom.decomposeInPlace()
-            vertex_data = geom.modifyVertexData()
-            vertex_data.format = GeomVertexFormat.get_v3()
-            view = memoryview(vertex_data.arrays[0]).cast("B").cast("f")
-            index_list = geom.primitives[0].getVertexList()
-            index_count = len(index_list)
-
-            for indices in (index_list[i:i+3] for i in range(0, index_count, 3)):
-                points = [Point3(*view[index*3:index*3+3]) for index in indices]
-                coll_poly = CollisionPolygon(*points)
-                collision_node.addSolid(coll_poly)
-
-    # model_root.hide()
+            if numpy == None:
+                polygons = collisionPolygons(geom)
+            else:
+                corners = collisionCorners(geom)
+                polygons = cornerPolygons(corners)
+                if model_node.name == height_node:
+                    terrain.append(corners)
+
+            for start in range(0, len(polygons), COLLISION_BATCH):
+                collision_node = CollisionNode(model_node.name)
+                for coll_poly in polygons[start:start + COLLISION_BATCH]:
+                    collision_node.addSolid(coll_poly)
+
+                collision_mesh = collision_root.attachNewNode(collision_node)
+                # collision nodes are hidden by default
+                collision_mesh.show()
+
+    return terrain
+
+def triangleGeom(geom):
+    # decompose a geom into plain triangles with a bare vertex format,
+    # returns its vertex data and triangle primitives
+    geom.decomposeInPlace()
+    vertex_data = geom.modifyVertexData()
+    vertex_data.format = GeomVertexFormat.get_v3()
+    # lines and points have no collision polygons
+    primitives = [primitive for primitive in geom.primitives if primitive.getPrimitiveType() == Geom.PT_polygons]
+    return vertex_data, primitives
+
+def collisionPolygons(geom):
+    # a CollisionPolygon for each non-degenerate triangle of a geom,
+    # one triangle at a time for when NumPy is missing
+    vertex_data, primitives = triangleGeom(geom)
+    view = memoryview(vertex_data.arrays[0]).cast("B").cast("f")
+    polygons = []
+    for primitive in primitives:
+        index_list = primitive.getVertexList()
+        for i in range(0, len(index_list) - 2, 3):
+            triangle = [tuple(view[index*3:index*3+3]) for index in index_list[i:i+3]]
+            if triangleArea(*triangle) > DEGENERATE_AREA:
+                polygons.append(CollisionPolygon(*[Point3(*point) for point in triangle]))
+    return polygons
+
+def collisionCorners(geom):
+    # the (N, 3, 3) corners of the non-degenerate triangles of a geom, the
+    # buffers are read whole and the triangles are sorted into strips of
+    # nearby ones so each batch covers a small area
+    vertex_data, primitives = triangleGeom(geom)
+    vertices = numpy.frombuffer(memoryview(vertex_data.arrays[0]).cast("B"), dtype = numpy.float32).reshape(-1, 3)
+    index_arrays = [primitiveIndices(primitive) for primitive in primitives]
+    if len(index_arrays) == 0:
+        return numpy.empty((0, 3, 3))
+    indices = numpy.concatenate(index_arrays)
+    indices = indices[:len(indices) - len(indices) % 3].reshape(-1, 3)
+    corners = vertices[indices].astype(numpy.float64)
+
+    # twice the area of each triangle from the cross product of two edges
+    cross = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    corners = corners[numpy.sqrt((cross * cross).sum(axis = 1)) > 2 * DEGENERATE_AREA]
+
+    # strips along y of whole batches, each ordered along x
+    centers = corners.mean(axis = 1)
+    batches = -(-len(corners) // COLLISION_BATCH)
+    strip_size = COLLISION_BATCH * max(1, int(math.ceil(math.sqrt(batches))))
+    strips = numpy.empty(len(corners), dtype = numpy.int64)
+    strips[numpy.argsort(centers[:, 1], kind = "stable")] = numpy.arange(len(corners)) // strip_size
+    return corners[numpy.lexsort((centers[:, 0], strips))]
+
+def cornerPolygons(corners):
+    # one Point3 per corner from whole columns, then every 3 make a triangle
+    x, y, z = corners.reshape(-1, 3).T.tolist()
+    points = list(map(Point3, x, y, z))
+    return list(map(CollisionPolygon, points[0::3], points[1::3], points[2::3]))
+
+def primitiveIndices(primitive):
+    # vertex indices of a primitive as a NumPy array
+    if not primitive.isIndexed():
+        first = primitive.getFirstVertex()
+        return numpy.arange(first, first + primitive.getNumVertices(), dtype = numpy.int64)
+
+    index_types = {Geom.NT_uint8: numpy.uint8, Geom.NT_uint16: numpy.uint16, Geom.NT_uint32: numpy.uint32}
+    index_view = memoryview(primitive.getVertices()).cast("B")
+    return numpy.frombuffer(index_view, dtype = index_types[primitive.getIndexType()]).astype(numpy.int64)
+
+def triangleArea(a, b, c):
+    # area of the triangle a, b, c
+    u = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    v = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+    cross = (u[1]*v[2] - u[2]*v[1], u[2]*v[0] - u[0]*v[2], u[0]*v[1] - u[1]*v[0])
+    return math.sqrt(cross[0]*cross[0] + cross[1]*cross[1] + cross[2]*cross[2]) / 2
             
 def makeSquares(gridX = 30, gridY = 30, scale = 1, evpName = 'square', startPos = Point3D(0, 0, 0)):
     z_up = EggCoordinateSystem()
@@ -178,3 +378,108 @@ def makeSquaresEVPXZSparse(gridX = 30, gridY = 30, scale = 1, evpName = 'square'
             poly.addVertex(vp.addVertex(v))
                 
     return data
+
+def makeSquaresShared(gridX = 30, gridY = 30, scale = 1, evpName = 'square', hardZ = 0, xz = True):
+    # the same grid as makeSquaresEVPXZ (makeSquaresEVP with xz False)
+    # but with one vertex pool, each corner vertex is made once and
+    # shared by the squares around it
+    z_up = EggCoordinateSystem()
+    z_up.setValue(CSZupRight)
+
+    data = EggData()
+    data.addChild(z_up)
+
+    vp = EggVertexPool(evpName)
+    data.addChild(vp)
+
+    vertices = []
+    for y in range(gridY + 1):
+        for x in range(gridX + 1):
+            v = EggVertex()
+            if xz:
+                v.setPos(Point3D(x*scale, hardZ, y*scale))
+            else:
+                v.setPos(Point3D(x*scale, y*scale, hardZ))
+            vertices.append(vp.addVertex(v))
+
+    # corners in the order of the other builders
+    width = gridX + 1
+    for y in range(gridY):
+        for x in range(gridX):
+            poly = EggPolygon()
+            data.addChild(poly)
+
+            corner = y*width + x
+            poly.addVertex(vertices[corner])
+            poly.addVertex(vertices[corner + 1])
+            poly.addVertex(vertices[corner + width + 1])
+            poly.addVertex(vertices[corner + width])
+
+    return data
+
+def makeSquaresArrays(gridX = 30, gridY = 30, scale = 1, hardZ = 0, xz = True):
+    # the shared corner vertices of a grid of squares as a flat float32
+    # x, y, z array, row by row, and a flat uint32 array of vertex
+    # indices, two triangles per square wound like the egg polygons
+    width = gridX + 1
+    if numpy == None:
+        vertices = array('f')
+        for y in range(gridY + 1):
+            for x in range(width):
+                if xz:
+                    vertices.extend((x*scale, hardZ, y*scale))
+                else:
+                    vertices.extend((x*scale, y*scale, hardZ))
+
+        indices = array('I')
+        for y in range(gridY):
+            for x in range(gridX):
+                corner = y*width + x
+                indices.extend((corner, corner + 1, corner + width + 1, corner, corner + width + 1, corner + width))
+        return vertices, indices
+
+    rows, cols = numpy.mgrid[0:gridY + 1, 0:width]
+    vertices = numpy.empty((gridY + 1, width, 3), dtype = numpy.float32)
+    vertices[:, :, 0] = cols * scale
+    vertices[:, :, 1 if xz else 2] = hardZ
+    vertices[:, :, 2 if xz else 1] = rows * scale
+
+    corner = (rows[:-1, :-1] * width + cols[:-1, :-1]).ravel().astype(numpy.uint32)
+    indices = numpy.stack((corner, corner + 1, corner + width + 1, corner, corner + width + 1, corner + width), axis = 1)
+    return vertices.ravel(), indices.ravel()
+
+def makeSquaresGeom(gridX = 30, gridY = 30, scale = 1, name = 'square', hardZ = 0, xz = True):
+    # a GeomNode of the grid made straight from makeSquaresArrays,
+    # both buffers are filled with a single copy each
+    vertices, indices = makeSquaresArrays(gridX, gridY, scale, hardZ, xz)
+
+    vertex_data = GeomVertexData(name, GeomVertexFormat.getV3(), Geom.UHStatic)
+    vertex_data.uncleanSetNumRows(len(vertices) // 3)
+    memoryview(vertex_data.modifyArray(0)).cast("B")[:] = memoryview(vertices).cast("B")
+
+    triangles = GeomTriangles(Geom.UHStatic)
+    triangles.setIndexType(Geom.NT_uint32)
+    index_array = triangles.modifyVertices()
+    index_array.uncleanSetNumRows(len(indices))
+    memoryview(index_array).cast("B")[:] = memoryview(indices).cast("B")
+
+    geom = Geom(vertex_data)
+    geom.addPrimitive(triangles)
+    geom_node = GeomNode(name)
+    geom_node.addGeom(geom)
+    return geom_node
+
+def makeSquaresQuads(gridX = 30, gridY = 30, scale = 1, squares = None):
+    # the grid in the flat quad form NavMeshGenerator takes in place of
+    # a Full or Coll egg, four x then four z corner coordinates per
+    # square, squares optionally lists the (x, y) squares to keep
+    if squares == None:
+        squares = ((x, y) for y in range(gridY) for x in range(gridX))
+
+    quads = array('d')
+    for x, y in squares:
+        x0 = x*scale
+        y0 = y*scale
+        quads.extend((x0, x0 + scale, x0 + scale, x0, y0, y0, y0 + scale, y0 + scale))
+
+    return quads
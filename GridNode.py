@@ -1,23 +1,26 @@
 class GridNode():     
-    def __init__(self, nodeNo, v1, v2, v3, v4):
+    # Nodes are created per grid cell, so keep them small
+    __slots__ = ('nodeNo', 'x', 'z', 'y', 'height', 'neighbors', 'r', 'c')
+    
+    # x and z hold the four corner coordinates in quad order,
+    # the vertical axis is flattened away, y is the terrain height
+    # at the cell center and height how far the terrain rises
+    # across the cell, both stay 0 without terrain
+    def __init__(self, nodeNo, x, z):
         self.nodeNo = nodeNo
+        self.x = x
+        self.z = z
+        self.y = 0.0
+        self.height = 0.0
         
-        self.vertex = []
-        self.vertex.append(v1.getPos4())
-        self.vertex.append(v2.getPos4())
-        self.vertex.append(v3.getPos4())
-        self.vertex.append(v4.getPos4())
-        
-        self.quad = []
-        for i in range(4):
-            self.quad.append(self.nodeNo * 4 + i)
-            self.vertex[i].setY(0)
-            
-        self.neighbors = []
-        for i in range(8):
-            self.neighbors.append(None)
+        self.neighbors = [None] * 8
             
     def setRC(self, r, c):
         self.r = r
         self.c = c
+    
+    # Indices of the quad corners
+    @property
+    def quad(self):
+        return [self.nodeNo * 4 + i for i in range(4)]
         
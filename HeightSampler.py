@@ -0,0 +1,169 @@
+from math import floor
+import hashlib
+
+import numpy
+
+# Largest number of grid cells along either side
+MAX_CELLS = 2048
+
+# Slack on the inside test so points on a shared edge are not missed
+EDGE_EPSILON = 1e-9
+
+
+class HeightSampler():
+    # Terrain height queries without casting rays, the terrain triangles
+    # are hashed into the cells of a regular X/Y grid and a query only
+    # tests the few triangles of the cell under the point, returning the
+    # highest surface there (what a ray cast down from above hits first)
+    # triangles holds per triangle the corner a (x, y), the edges a->b
+    # and a->c (x, y), 1 / the X/Y determinant, then a.z and the two edge
+    # z deltas, cellStart/cellTriangles list the triangles of each cell
+    def __init__(self, triangles, cellStart, cellTriangles, originX, originY, cellSize, rows, cols):
+        self.triangles = triangles
+        self.cellStart = cellStart
+        self.cellTriangles = cellTriangles
+
+        self.originX = originX
+        self.originY = originY
+        self.cellSize = cellSize
+        self.rows = rows
+        self.cols = cols
+
+    # Build from an (N, 3, 3) array of triangle corners, cellSize defaults
+    # to the median X/Y extent of the triangles so most touch 1-4 cells
+    @classmethod
+    def fromTriangles(cls, corners, cellSize = None):
+        corners = numpy.asarray(corners, dtype = numpy.float64).reshape(-1, 3, 3)
+
+        # Only triangles facing up are kept, like the collision polygons
+        # a downward ray can hit, walls seen edge on are left out too
+        ab = corners[:, 1] - corners[:, 0]
+        ac = corners[:, 2] - corners[:, 0]
+        det = ab[:, 0] * ac[:, 1] - ac[:, 0] * ab[:, 1]
+        keep = det > 1e-12
+        corners, ab, ac, det = corners[keep], ab[keep], ac[keep], det[keep]
+
+        if len(corners) == 0:
+            return cls(numpy.empty((0, 10)), numpy.zeros(2, dtype = numpy.int64), numpy.empty(0, dtype = numpy.int64),
+                       0.0, 0.0, 1.0, 1, 1)
+
+        triangles = numpy.column_stack((corners[:, 0, 0], corners[:, 0, 1], ab[:, 0], ab[:, 1], ac[:, 0], ac[:, 1],
+                                        1.0 / det, corners[:, 0, 2], ab[:, 2], ac[:, 2]))
+
+        low = corners[:, :, :2].min(axis = 1)
+        high = corners[:, :, :2].max(axis = 1)
+        originX, originY = low.min(axis = 0)
+        maxX, maxY = high.max(axis = 0)
+
+        if cellSize == None:
+            cellSize = float(numpy.median((high - low).max(axis = 1)))
+        cellSize = max(cellSize, (maxX - originX) / MAX_CELLS, (maxY - originY) / MAX_CELLS)
+        if cellSize <= 0:
+            cellSize = 1.0
+
+        cols = int(floor((maxX - originX) / cellSize)) + 1
+        rows = int(floor((maxY - originY) / cellSize)) + 1
+
+        # One (cell, triangle) pair per cell each triangle's bounds touch
+        c0 = numpy.floor((low[:, 0] - originX) / cellSize).astype(numpy.int64)
+        c1 = numpy.minimum(numpy.floor((high[:, 0] - originX) / cellSize).astype(numpy.int64), cols - 1)
+        r0 = numpy.floor((low[:, 1] - originY) / cellSize).astype(numpy.int64)
+        r1 = numpy.minimum(numpy.floor((high[:, 1] - originY) / cellSize).astype(numpy.int64), rows - 1)
+        width = c1 - c0 + 1
+        counts = width * (r1 - r0 + 1)
+
+        triangle = numpy.repeat(numpy.arange(len(corners)), counts)
+        k = numpy.arange(int(counts.sum())) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cell = (r0[triangle] + k // width[triangle]) * cols + c0[triangle] + k % width[triangle]
+
+        order = numpy.argsort(cell, kind = 'stable')
+        cellStart = numpy.zeros(rows * cols + 1, dtype = numpy.int64)
+        cellStart[1:] = numpy.cumsum(numpy.bincount(cell, minlength = rows * cols))
+
+        return cls(triangles, cellStart, triangle[order], float(originX), float(originY), cellSize, rows, cols)
+
+    # Height of the terrain at world point x, y, None off the terrain
+    def heightAt(self, x, y):
+        c = int(floor((x - self.originX) / self.cellSize))
+        r = int(floor((y - self.originY) / self.cellSize))
+        if not(0 <= c < self.cols and 0 <= r < self.rows):
+            return None
+
+        cell = r * self.cols + c
+        best = None
+        for t in self.cellTriangles[self.cellStart.item(cell):self.cellStart.item(cell + 1)].tolist():
+            ax, ay, abx, aby, acx, acy, invDet, az, abz, acz = self.triangles[t].tolist()
+            px = x - ax
+            py = y - ay
+            u = (px * acy - acx * py) * invDet
+            v = (abx * py - px * aby) * invDet
+            if u >= -EDGE_EPSILON and v >= -EDGE_EPSILON and u + v <= 1 + EDGE_EPSILON:
+                z = az + u * abz + v * acz
+                if best == None or z > best:
+                    best = z
+        return best
+
+    # Batch version of heightAt for arrays of x and y,
+    # returns NaN where a point is off the terrain
+    def heightsAt(self, xs, ys):
+        xs = numpy.atleast_1d(numpy.asarray(xs, dtype = numpy.float64))
+        ys = numpy.atleast_1d(numpy.asarray(ys, dtype = numpy.float64))
+        c = numpy.floor((xs - self.originX) / self.cellSize)
+        r = numpy.floor((ys - self.originY) / self.cellSize)
+        inside = (c >= 0) & (c < self.cols) & (r >= 0) & (r < self.rows)
+        cell = numpy.where(inside, r * self.cols + c, 0).astype(numpy.int64)
+
+        # One (query, triangle) pair per triangle in the query's cell
+        start = self.cellStart[cell]
+        counts = numpy.where(inside, self.cellStart[cell + 1] - start, 0)
+        query = numpy.repeat(numpy.arange(len(xs)), counts)
+        k = numpy.arange(int(counts.sum())) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        tri = self.triangles[self.cellTriangles[start[query] + k]]
+
+        px = xs[query] - tri[:, 0]
+        py = ys[query] - tri[:, 1]
+        u = (px * tri[:, 5] - tri[:, 4] * py) * tri[:, 6]
+        v = (tri[:, 2] * py - px * tri[:, 3]) * tri[:, 6]
+        hit = (u >= -EDGE_EPSILON) & (v >= -EDGE_EPSILON) & (u + v <= 1 + EDGE_EPSILON)
+        z = tri[:, 7] + u * tri[:, 8] + v * tri[:, 9]
+
+        heights = numpy.full(len(xs), -numpy.inf)
+        numpy.fmax.at(heights, query[hit], z[hit])
+        heights[numpy.isinf(heights)] = numpy.nan
+        return heights
+
+    # Move the terrain by dx, dy, the triangle corners along with the grid
+    def translate(self, dx, dy):
+        self.triangles[:, 0] += dx
+        self.triangles[:, 1] += dy
+        self.originX = self.originX + dx
+        self.originY = self.originY + dy
+
+    # Save to a .npz file, tags are extra strings kept with it
+    def save(self, filename, **tags):
+        with open(filename, 'wb') as file:
+            numpy.savez(file, triangles = self.triangles, cellStart = self.cellStart, cellTriangles = self.cellTriangles,
+                        grid = numpy.array([self.originX, self.originY, self.cellSize, self.rows, self.cols]),
+                        **dict((name, numpy.array(value)) for name, value in tags.items()))
+
+    # Load a saved sampler, returns it with its tags
+    @classmethod
+    def load(cls, filename):
+        with numpy.load(filename) as data:
+            grid = data['grid']
+            tags = dict((name, str(data[name])) for name in data.files
+                        if not(name in ('triangles', 'cellStart', 'cellTriangles', 'grid')))
+            sampler = cls(data['triangles'], data['cellStart'], data['cellTriangles'],
+                          float(grid[0]), float(grid[1]), float(grid[2]), int(grid[3]), int(grid[4]))
+            return sampler, tags
+
+    # Hash of the terrain triangles and where the terrain is placed,
+    # for cache keys of anything generated from the terrain
+    def digest(self):
+        digest = hashlib.sha256(numpy.ascontiguousarray(self.triangles).tobytes())
+        digest.update(numpy.array([self.originX, self.originY, self.cellSize], dtype = numpy.float64).tobytes())
+        return digest.hexdigest()
+
+    # True when there is no terrain to sample
+    def isEmpty(self):
+        return len(self.triangles) == 0
@@ -0,0 +1,473 @@
+from array import array
+from heapq import heappush, heappop
+
+from PathFinder import STEP_COSTS, STRAIGHT_COST, DIAGONAL_COST, SLOT_DIRECTIONS, DIRECTION_SLOTS
+
+# Neighbor slots that step straight across a cluster border
+STRAIGHT_SLOTS = (1, 3, 5, 7)
+
+# Border runs at least this long get an entrance at each end,
+# shorter runs a single one at their middle
+LONG_RUN = 6
+
+
+class HierarchicalPathFinder():
+    # HPA* layer over a PathFinder, the grid is split into square
+    # clusters of clusterSize cells, the links crossing cluster borders
+    # become entrances and the costs from and to every entrance over
+    # its cluster are precomputed, long queries then search the small
+    # entrance graph and trace the chosen route back through those costs
+    # start and goal joined by a straight octile walk, or in the same or
+    # neighboring clusters, are answered without the entrance graph,
+    # routes through it can still bend towards entrances near cluster
+    # borders, the refined path is smoothed with straight octile walks
+    # and the flat search is used whenever the entrance graph finds no route
+    def __init__(self, finder, clusterSize = 16):
+        self.finder = finder
+        self.clusterSize = clusterSize
+
+        # Abstract graph, entrance cell -> [(cell, cost), ...]
+        self.edges = {}
+        # Entrance cells of each cluster
+        self.clusterEntrances = {}
+        # Entrance cell -> cost from the entrance to every cell of its
+        # cluster, and from every cell to the entrance, -1 for no path,
+        # indexed by localIndex()
+        self.costMaps = {}
+        self.reverseMaps = {}
+        # Grid version the abstract graph was built for
+        self.version = None
+
+        # Abstract nodes expanded by the last query
+        self.expanded = 0
+
+    # Build the abstract graph, done lazily on the first query
+    # and again after the finder's navmesh changed
+    def build(self):
+        self.edges = {}
+        self.clusterEntrances = {}
+        self.costMaps = {}
+        self.reverseMaps = {}
+
+        for src, dst, cost in self.findTransitions():
+            self.addEntrance(src)
+            self.addEntrance(dst)
+            self.edges[src].append((dst, cost))
+
+        # Costs between the entrances of each cluster, the links of a
+        # cluster are gathered once for all of its entrances
+        for cluster, entrances in self.clusterEntrances.items():
+            links, reverseLinks = self.clusterLinks(cluster)
+            for src in entrances:
+                self.costMaps[src] = self.clusterCosts(src, cluster, links)
+                self.reverseMaps[src] = self.clusterCosts(src, cluster, reverseLinks)
+
+            for src in entrances:
+                costs = self.costMaps[src]
+                for dst in entrances:
+                    cost = costs[self.localIndex(dst, cluster)]
+                    if not(dst == src) and cost >= 0:
+                        self.edges[src].append((dst, cost))
+
+        self.version = self.finder.version
+
+    def addEntrance(self, cell):
+        if not(cell in self.edges):
+            self.edges[cell] = []
+            self.clusterEntrances.setdefault(self.clusterOf(cell), []).append(cell)
+
+    # Directed (src, dst, cost) links chosen as entrances, contiguous
+    # runs of straight links along a border become an entrance at each
+    # end of the run, or one at its middle when the run is short,
+    # diagonal links are kept unless a straight run between the same
+    # two clusters touches them, so corner links are always kept
+    def findTransitions(self):
+        finder = self.finder
+        gridSize = finder.gridSize
+        neighbors = finder.neighbors
+
+        # Straight border links grouped by (src cluster, dst cluster, slot)
+        runs = {}
+        diagonals = []
+        for cell in range(gridSize * gridSize):
+            if not finder.walkable[cell]:
+                continue
+            cluster = self.clusterOf(cell)
+            for i in range(8):
+                nextCell = neighbors[cell * 8 + i]
+                if nextCell < 0 or self.clusterOf(nextCell) == cluster:
+                    continue
+                if i in STRAIGHT_SLOTS:
+                    runs.setdefault((cluster, self.clusterOf(nextCell), i), []).append((cell, nextCell))
+                else:
+                    diagonals.append((cell, nextCell, STEP_COSTS[i]))
+
+        transitions = []
+        # (cell, cluster across the border) of every straight link
+        straightCells = set()
+        for links in runs.values():
+            links.sort()
+            run = [links[0]]
+            for link in links[1:]:
+                # Cells along a border are consecutive in row or col
+                if link[0] - run[-1][0] in (1, gridSize):
+                    run.append(link)
+                else:
+                    transitions.extend(self.runEntrances(run))
+                    run = [link]
+            transitions.extend(self.runEntrances(run))
+
+            for src, dst in links:
+                straightCells.add((src, self.clusterOf(dst)))
+                straightCells.add((dst, self.clusterOf(src)))
+
+        for src, dst, cost in diagonals:
+            if not((src, self.clusterOf(dst)) in straightCells or (dst, self.clusterOf(src)) in straightCells):
+                transitions.append((src, dst, cost))
+
+        return transitions
+
+    # Entrance links of one straight border run
+    def runEntrances(self, run):
+        if len(run) >= LONG_RUN:
+            return [run[0] + (STRAIGHT_COST,), run[-1] + (STRAIGHT_COST,)]
+        return [run[len(run) // 2] + (STRAIGHT_COST,)]
+
+    # Find a path between two (row, col) cells, returns the
+    # list of cells from start to goal or [] when there is none
+    def findPath(self, start, goal):
+        finder = self.finder
+        if not(self.version == finder.version):
+            self.build()
+
+        gridSize = finder.gridSize
+        if not(finder.inGrid(start) and finder.inGrid(goal)):
+            return []
+        startCell = start[0] * gridSize + start[1]
+        goalCell = goal[0] * gridSize + goal[1]
+        if not(finder.walkable[startCell] and finder.walkable[goalCell]):
+            return []
+
+        # No path is cheaper than an open straight octile walk
+        walk = self.octileWalk(startCell, goalCell)
+        if not(walk == None):
+            return walk
+
+        # Short queries are searched inside the clusters of start and
+        # goal first, a path there as cheap as the octile distance is
+        # optimal, otherwise it is kept if the routed path is no cheaper
+        path = []
+        startCluster = self.clusterOf(startCell)
+        goalCluster = self.clusterOf(goalCell)
+        if abs(startCluster[0] - goalCluster[0]) <= 1 and abs(startCluster[1] - goalCluster[1]) <= 1:
+            startBounds = self.clusterBounds(startCluster)
+            goalBounds = self.clusterBounds(goalCluster)
+            bounds = (min(startBounds[0], goalBounds[0]), min(startBounds[1], goalBounds[1]),
+                      max(startBounds[2], goalBounds[2]), max(startBounds[3], goalBounds[3]))
+            path = finder.findPath(start, goal, bounds)
+            if len(path) > 0 and self.pathCost(path) == self.octileCost(startCell, goalCell):
+                return path
+
+        route = self.searchAbstract(startCell, goalCell)
+        if route == None:
+            if len(path) > 0:
+                return path
+            return finder.findPath(start, goal)
+
+        routed = self.smooth(self.refine(route))
+        if len(path) > 0 and self.pathCost(path) <= self.pathCost(routed):
+            return path
+        return routed
+
+    # A* over the entrance graph with start and goal linked
+    # to the entrances of their clusters
+    def searchAbstract(self, startCell, goalCell):
+        startCluster = self.clusterOf(startCell)
+        startLocal = self.localIndex(startCell, startCluster)
+        startEdges = []
+        for cell in self.clusterEntrances.get(startCluster, []):
+            cost = self.reverseMaps[cell][startLocal]
+            if cost >= 0 and not(cell == startCell):
+                startEdges.append((cell, cost))
+
+        goalCluster = self.clusterOf(goalCell)
+        goalLocal = self.localIndex(goalCell, goalCluster)
+        goalCosts = {}
+        for cell in self.clusterEntrances.get(goalCluster, []):
+            cost = self.costMaps[cell][goalLocal]
+            if cost >= 0 and not(cell == goalCell):
+                goalCosts[cell] = cost
+
+        gScore = {startCell: 0}
+        parent = {startCell: None}
+        closed = set()
+        openHeap = [(0, 0, startCell)]
+        expanded = 0
+
+        while len(openHeap) > 0:
+            f, h, cell = heappop(openHeap)
+            if cell in closed:
+                continue
+            closed.add(cell)
+            expanded = expanded + 1
+
+            if cell == goalCell:
+                self.expanded = expanded
+                route = []
+                while not(cell == None):
+                    route.append(cell)
+                    cell = parent[cell]
+                route.reverse()
+                return route
+
+            if cell == startCell:
+                edges = startEdges + self.edges.get(cell, [])
+            else:
+                edges = list(self.edges.get(cell, []))
+                if cell in goalCosts:
+                    edges.append((goalCell, goalCosts[cell]))
+
+            for nextCell, cost in edges:
+                nextG = gScore[cell] + cost
+                if nextCell in closed or nextG >= gScore.get(nextCell, nextG + 1):
+                    continue
+                gScore[nextCell] = nextG
+                parent[nextCell] = cell
+
+                h = self.octileCost(nextCell, goalCell)
+                heappush(openHeap, (nextG + h, h, nextCell))
+
+        self.expanded = expanded
+        return None
+
+    # Turn a route of entrance cells into a full cell path, each leg
+    # inside a cluster is traced back through the precomputed costs
+    def refine(self, route):
+        gridSize = self.finder.gridSize
+        path = [divmod(route[0], gridSize)]
+
+        for src, dst in zip(route, route[1:]):
+            cluster = self.clusterOf(src)
+            if not(cluster == self.clusterOf(dst)):
+                # Border link, a single step
+                path.append(divmod(dst, gridSize))
+            elif src in self.costMaps:
+                path.extend(self.traceFrom(src, dst, cluster)[1:])
+            else:
+                # Only the start is not an entrance
+                path.extend(self.traceTo(src, dst, cluster)[1:])
+
+        return path
+
+    # Cells from entrance src to dst, walking back from dst
+    # through the costs from src
+    def traceFrom(self, src, dst, cluster):
+        finder = self.finder
+        gridSize = finder.gridSize
+        neighbors = finder.neighbors
+        costs = self.costMaps[src]
+        r0, c0, r1, c1 = self.clusterBounds(cluster)
+        width = c1 - c0
+
+        cell = dst
+        path = [divmod(dst, gridSize)]
+        while not(cell == src):
+            r, c = divmod(cell, gridSize)
+            cost = costs[(r - r0) * width + c - c0]
+            # A neighbor linking to cell one step cheaper
+            for i in range(8):
+                pr = r - SLOT_DIRECTIONS[i][0]
+                pc = c - SLOT_DIRECTIONS[i][1]
+                if r0 <= pr < r1 and c0 <= pc < c1:
+                    prevCost = costs[(pr - r0) * width + pc - c0]
+                    if prevCost >= 0 and prevCost + STEP_COSTS[i] == cost and neighbors[(pr * gridSize + pc) * 8 + i] == cell:
+                        break
+            cell = pr * gridSize + pc
+            path.append((pr, pc))
+
+        path.reverse()
+        return path
+
+    # Cells from src to entrance dst, walking forward from src
+    # through the costs to dst
+    def traceTo(self, src, dst, cluster):
+        finder = self.finder
+        gridSize = finder.gridSize
+        neighbors = finder.neighbors
+        costs = self.reverseMaps[dst]
+        r0, c0, r1, c1 = self.clusterBounds(cluster)
+        width = c1 - c0
+
+        cell = src
+        path = [divmod(src, gridSize)]
+        while not(cell == dst):
+            r, c = divmod(cell, gridSize)
+            cost = costs[(r - r0) * width + c - c0]
+            # A linked neighbor one step closer to dst
+            for i in range(8):
+                nextCell = neighbors[cell * 8 + i]
+                if nextCell >= 0:
+                    nr, nc = divmod(nextCell, gridSize)
+                    if r0 <= nr < r1 and c0 <= nc < c1:
+                        nextCost = costs[(nr - r0) * width + nc - c0]
+                        if nextCost >= 0 and nextCost + STEP_COSTS[i] == cost:
+                            break
+            cell = nextCell
+            path.append((nr, nc))
+
+        return path
+
+    # Replace stretches of a path with straight octile walks, from each
+    # kept cell the look ahead doubles until a walk is blocked
+    def smooth(self, path):
+        gridSize = self.finder.gridSize
+        last = len(path) - 1
+        smoothed = [path[0]]
+        anchor = 0
+
+        while anchor < last:
+            anchorCell = path[anchor][0] * gridSize + path[anchor][1]
+            reach = anchor + 1
+            shortcut = None
+            ahead = 2
+            while anchor + ahead // 2 < last:
+                target = min(anchor + ahead, last)
+                walk = self.octileWalk(anchorCell, path[target][0] * gridSize + path[target][1])
+                if walk == None:
+                    break
+                reach = target
+                shortcut = walk
+                ahead = ahead * 2
+
+            if shortcut == None:
+                smoothed.append(path[reach])
+            else:
+                smoothed.extend(shortcut[1:])
+            anchor = reach
+
+        return smoothed
+
+    # Cost of a cell path, every step is straight or diagonal
+    def pathCost(self, path):
+        cost = 0
+        for a, b in zip(path, path[1:]):
+            if a[0] == b[0] or a[1] == b[1]:
+                cost = cost + STRAIGHT_COST
+            else:
+                cost = cost + DIAGONAL_COST
+        return cost
+
+    # Octile distance between two cells, no path is cheaper
+    def octileCost(self, cell, goalCell):
+        gridSize = self.finder.gridSize
+        dr = abs(cell // gridSize - goalCell // gridSize)
+        dc = abs(cell % gridSize - goalCell % gridSize)
+        return STRAIGHT_COST * max(dr, dc) + (DIAGONAL_COST - STRAIGHT_COST) * min(dr, dc)
+
+    # Cells of a straight octile walk from cell to goalCell along
+    # existing links, the diagonal steps first or last, None
+    # when neither walk is open
+    def octileWalk(self, cell, goalCell):
+        gridSize = self.finder.gridSize
+        r, c = divmod(cell, gridSize)
+        goalRow, goalCol = divmod(goalCell, gridSize)
+        dr = (goalRow > r) - (goalRow < r)
+        dc = (goalCol > c) - (goalCol < c)
+        rows = abs(goalRow - r)
+        cols = abs(goalCol - c)
+
+        diagonal = ((dr, dc), min(rows, cols))
+        if rows > cols:
+            straight = ((dr, 0), rows - cols)
+        else:
+            straight = ((0, dc), cols - rows)
+
+        path = self.walkRuns(cell, (diagonal, straight))
+        if path == None and diagonal[1] > 0 and straight[1] > 0:
+            path = self.walkRuns(cell, (straight, diagonal))
+        return path
+
+    # Cells visited taking count steps in each (row step, col step)
+    # of runs from cell, None when a step has no link
+    def walkRuns(self, cell, runs):
+        gridSize = self.finder.gridSize
+        neighbors = self.finder.neighbors
+        path = [divmod(cell, gridSize)]
+
+        for step, count in runs:
+            if count == 0:
+                continue
+            slot = DIRECTION_SLOTS[step]
+            for i in range(count):
+                cell = neighbors[cell * 8 + slot]
+                if cell < 0:
+                    return None
+                path.append(divmod(cell, gridSize))
+
+        return path
+
+    # Forward and reverse links inside a cluster, lists of
+    # (cell, cost) by localIndex() of the cell they leave from
+    def clusterLinks(self, cluster):
+        finder = self.finder
+        gridSize = finder.gridSize
+        neighbors = finder.neighbors
+        r0, c0, r1, c1 = self.clusterBounds(cluster)
+        width = c1 - c0
+
+        links = [[] for i in range((r1 - r0) * width)]
+        reverseLinks = [[] for i in range((r1 - r0) * width)]
+        for r in range(r0, r1):
+            for c in range(c0, c1):
+                src = r * gridSize + c
+                srcLocal = (r - r0) * width + c - c0
+                for i in range(8):
+                    dst = neighbors[src * 8 + i]
+                    if dst < 0:
+                        continue
+                    dr, dc = divmod(dst, gridSize)
+                    if r0 <= dr < r1 and c0 <= dc < c1:
+                        dstLocal = (dr - r0) * width + dc - c0
+                        links[srcLocal].append((dstLocal, STEP_COSTS[i]))
+                        reverseLinks[dstLocal].append((srcLocal, STEP_COSTS[i]))
+
+        return links, reverseLinks
+
+    # Dijkstra from cell over the links of its cluster, returns the
+    # cost of every cell by localIndex(), -1 where there is no path
+    # with reverse links the costs are from every cell to the given one
+    def clusterCosts(self, cell, cluster, links):
+        costs = array('i', [-1]) * len(links)
+        start = self.localIndex(cell, cluster)
+        costs[start] = 0
+        openHeap = [(0, start)]
+
+        while len(openHeap) > 0:
+            cost, current = heappop(openHeap)
+            if cost > costs[current]:
+                continue
+
+            for nextLocal, step in links[current]:
+                nextCost = cost + step
+                if costs[nextLocal] < 0 or nextCost < costs[nextLocal]:
+                    costs[nextLocal] = nextCost
+                    heappush(openHeap, (nextCost, nextLocal))
+
+        return costs
+
+    def clusterOf(self, cell):
+        r, c = divmod(cell, self.finder.gridSize)
+        return (r // self.clusterSize, c // self.clusterSize)
+
+    # (r0, c0, r1, c1) cell bounds of a cluster
+    def clusterBounds(self, cluster):
+        gridSize = self.finder.gridSize
+        r0 = cluster[0] * self.clusterSize
+        c0 = cluster[1] * self.clusterSize
+        return (r0, c0, min(r0 + self.clusterSize, gridSize), min(c0 + self.clusterSize, gridSize))
+
+    # Index of a cell inside its cluster's cost maps
+    def localIndex(self, cell, cluster):
+        r, c = divmod(cell, self.finder.gridSize)
+        r0, c0, r1, c1 = self.clusterBounds(cluster)
+        return (r - r0) * (c1 - c0) + c - c0
@@ -0,0 +1,170 @@
+# Benchmarks for the navmesh generation pipeline
+# usage: python NavMeshBenchmark.py <benchmark> [grid sizes...]
+
+import os
+import sys
+import time
+import random
+from math import ceil
+
+from NavMeshGenerator import *
+from PathFinder import PathFinder
+import EggPrimitiveCreation
+
+
+# Build an open grid without writing it out
+def buildGrid(gridSize, scale = 10):
+    navmesh = NavMeshGenerator()
+    navmesh.createDirectGrid(gridSize, scale, None)
+    navmesh.createNeighbors()
+    return navmesh
+
+# Count the .csv rows a grid produces
+def countRows(navmesh):
+    rows = 0
+    for row in navmesh.finalList:
+        for node in row:
+            if node == None:
+                rows = rows + 1
+            else:
+                rows = rows + 9
+    return rows
+
+# Time writeToCSV on square grids of the given sizes
+def benchWriteCSV(sizes):
+    for gridSize in sizes:
+        navmesh = buildGrid(gridSize)
+        rows = countRows(navmesh)
+        
+        start = time.perf_counter()
+        navmesh.writeToCSV('bench_navmesh.csv')
+        elapsed = time.perf_counter() - start
+        os.remove('bench_navmesh.csv')
+        
+        print('csv %dx%d: %d rows in %.3fs, %.0f rows/sec' % (gridSize, gridSize, rows, elapsed, rows / elapsed))
+
+# Report peak RSS after a full build of each grid size,
+# run one size per process for independent numbers (Unix only)
+def benchPeakRSS(sizes):
+    import resource
+    
+    for gridSize in sizes:
+        start = time.perf_counter()
+        navmesh = buildGrid(gridSize)
+        navmesh.writeToCSV('bench_navmesh.csv')
+        elapsed = time.perf_counter() - start
+        os.remove('bench_navmesh.csv')
+        
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print('rss %dx%d: built in %.3fs, peak RSS %.0f MB' % (gridSize, gridSize, elapsed, peak))
+
+# Build a grid blocked by wall_test walls (10 units square at scale 10)
+# laid out like models/default_wall_positions.txt, larger grids repeat
+# the default layout every 300 units
+def buildWallGrid(gridSize, scale = 10):
+    walls = []
+    with open('models/default_wall_positions.txt', 'r') as file:
+        for line in file:
+            if len(line.strip()) > 0:
+                x, y = line.split(',')
+                walls.append((int(x), int(y)))
+    
+    navmesh = buildGrid(gridSize, scale)
+    navmesh.writeToCSV('bench_navmesh.csv')
+    cells = []
+    repeats = max(1, int(ceil(gridSize * scale / 300.0)))
+    for tileY in range(repeats):
+        for tileX in range(repeats):
+            for x, y in walls:
+                x = x + tileX * 300
+                y = y + tileY * 300
+                cells.extend(navmesh.cellsInBounds(x - 5, y - 5, x + 5, y + 5))
+    navmesh.setCellsBlocked(cells)
+    os.remove('bench_navmesh.csv')
+    return navmesh
+
+# Compare plain A* against Jump Point Search on wall grids of the
+# given sizes, random walkable start/goal pairs, same pairs for both
+def benchJumpPoints(sizes, queries = 200):
+    for gridSize in sizes:
+        finder = PathFinder.fromNavMesh(buildWallGrid(gridSize))
+        cells = [divmod(cell, gridSize) for cell in range(gridSize * gridSize) if finder.walkable[cell]]
+        rand = random.Random(gridSize)
+        pairs = [(rand.choice(cells), rand.choice(cells)) for i in range(queries)]
+        
+        # Jump tables are built once per navmesh version
+        start = time.perf_counter()
+        finder.buildJumpTables()
+        print('jps %dx%d: jump tables built in %.3fs' % (gridSize, gridSize, time.perf_counter() - start))
+        
+        for name, search in (('astar', finder.findPath), ('jps', finder.findPathJPS)):
+            expanded = 0
+            steps = 0
+            start = time.perf_counter()
+            for startCell, goalCell in pairs:
+                steps = steps + len(search(startCell, goalCell))
+                expanded = expanded + finder.expanded
+            elapsed = time.perf_counter() - start
+            
+            print('%s %dx%d: %d queries in %.3fs, %.0f queries/sec, %.1f expanded/query, %d path cells' %
+                  (name, gridSize, gridSize, queries, elapsed, queries / elapsed, expanded / float(queries), steps))
+
+# Compare the .csv and binary navmesh formats, write time, file
+# size and the time PathFinder takes to load each
+def benchBinary(sizes):
+    for gridSize in sizes:
+        navmesh = buildGrid(gridSize)
+        
+        for name, write, load, filename in (('csv', navmesh.writeToCSV, PathFinder.fromCSV, 'bench_navmesh.csv'),
+                                            ('binary', navmesh.writeToBinary, PathFinder.fromBinary, 'bench_navmesh.nav')):
+            start = time.perf_counter()
+            write(filename)
+            written = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            finder = load(filename)
+            loaded = time.perf_counter() - start
+            
+            size = os.path.getsize(filename) / 1048576.0
+            del finder
+            os.remove(filename)
+            print('%s %dx%d: %.1f MB, written in %.3fs, loaded in %.4fs' % (name, gridSize, gridSize, size, written, loaded))
+
+# Time the grid builders of EggPrimitiveCreation on square grids,
+# the per square egg builders against the shared vertex pool, the
+# Geom buffers and the flat quad arrays NavMeshGenerator takes
+def benchEggGrid(sizes):
+    builders = (
+        ('EVP', lambda n: EggPrimitiveCreation.makeSquaresEVP(n, n, 10, 'Full', 0)),
+        ('EVPXZ', lambda n: EggPrimitiveCreation.makeSquaresEVPXZ(n, n, 10, 'Full', 0)),
+        ('shared', lambda n: EggPrimitiveCreation.makeSquaresShared(n, n, 10, 'Full', 0)),
+        ('geom', lambda n: EggPrimitiveCreation.makeSquaresGeom(n, n, 10, 'Full', 0)),
+        ('quads', lambda n: EggPrimitiveCreation.makeSquaresQuads(n, n, 10)),
+    )
+    
+    for gridSize in sizes:
+        for name, build in builders:
+            start = time.perf_counter()
+            grid = build(gridSize)
+            elapsed = time.perf_counter() - start
+            del grid
+            print('%s %dx%d: built in %.3fs, %.0f squares/sec' % (name, gridSize, gridSize, elapsed, gridSize * gridSize / elapsed))
+
+
+BENCHMARKS = {
+    'csv': (benchWriteCSV, [100, 300, 1000]),
+    'rss': (benchPeakRSS, [1000]),
+    'jps': (benchJumpPoints, [30, 500]),
+    'binary': (benchBinary, [100, 1000]),
+    'egg': (benchEggGrid, [100, 300, 1000]),
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: python NavMeshBenchmark.py <' + '|'.join(BENCHMARKS) + '> [grid sizes...]')
+        sys.exit(1)
+    
+    bench, sizes = BENCHMARKS[sys.argv[1]]
+    if len(sys.argv) > 2:
+        sizes = [int(size) for size in sys.argv[2:]]
+    bench(sizes)
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+
+
+class NavMeshCache():
+    # Generated navmesh files are stored under cacheDir, named by
+    # the content hash of their inputs, and the least recently used
+    # entries are evicted once the directory grows past maxSize bytes
+    # side-files such as the navmesh grid are kept next to an entry
+    # under the same key with their own extension
+    def __init__(self, cacheDir = 'navmesh_cache', maxSize = 256 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+    
+    # Build a cache key from the generator inputs,
+    # parts may be bytes or anything with a stable str()
+    def makeKey(self, *parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = bytes(str(part), 'utf-8')
+            # Length prefix so adjacent parts cannot run together
+            digest.update(bytes(str(len(part)) + ':', 'utf-8'))
+            digest.update(part)
+        return digest.hexdigest()
+    
+    def entryPath(self, key, extension = '.csv'):
+        return os.path.join(self.cacheDir, key + extension)
+    
+    # Copy the cached navmesh for key to filename,
+    # returns False when there is no valid entry
+    def fetch(self, key, filename):
+        path = self.entryPath(key)
+        if not os.path.isfile(path):
+            return False
+        
+        shutil.copyfile(path, filename)
+        # Mark the entry as recently used
+        os.utime(path)
+        return True
+    
+    # Store a freshly generated navmesh under key
+    def store(self, key, filename):
+        # Copy next to the entry first so a partial copy is never served
+        path = self.entryPath(key)
+        shutil.copyfile(filename, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.evict()
+    
+    # Path of the side-file of key with extension, read in
+    # place, None when there is none
+    def sidePath(self, key, extension):
+        path = self.entryPath(key, extension)
+        if not os.path.isfile(path):
+            return None
+        
+        os.utime(path)
+        return path
+    
+    # Store a side-file of key, write(filename) writes it
+    def storeSide(self, key, extension, write):
+        path = self.entryPath(key, extension)
+        write(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.evict()
+    
+    # Drop the entry for key and its side-files, or every
+    # entry when key is None
+    def invalidate(self, key = None):
+        if key == None:
+            for path in self.entries():
+                os.remove(path)
+            return
+        
+        for path in self.entries():
+            if os.path.basename(path).startswith(key + '.'):
+                os.remove(path)
+    
+    # Remove least recently used entries until
+    # the cache fits in maxSize bytes
+    def evict(self):
+        entries = sorted(self.entries(), key = os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        
+        while total > self.maxSize and len(entries) > 0:
+            path = entries.pop(0)
+            total = total - os.path.getsize(path)
+            os.remove(path)
+    
+    def entries(self):
+        # Every navmesh and side-file, copies still being written are left out
+        paths = [os.path.join(self.cacheDir, name) for name in os.listdir(self.cacheDir) if not name.endswith('.tmp')]
+        return [path for path in paths if os.path.isfile(path)]
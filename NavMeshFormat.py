@@ -0,0 +1,31 @@
+import struct
+
+# Binary navmesh layout written by NavMeshGenerator.writeToBinary and
+# read by PathFinder.fromBinary, a 64 byte little endian header (magic,
+# format version, flags, gridSize, originX, originY, cellLength,
+# cellWidth) followed by one walkable byte per cell and, from an 8 byte
+# aligned offset, 8 int32 neighbor cell indices per cell (-1 for none)
+# in the neighbor slot order of NavMeshGenerator.setNeighbors
+BINARY_MAGIC = b'PNAV'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHI4d20x')
+
+# Offset of the neighbor array in a binary navmesh
+def binaryNeighborsOffset(gridSize):
+    return (BINARY_HEADER.size + gridSize * gridSize + 7) & ~7
+
+# Grid side-file kept with a cached navmesh.csv, read back by
+# NavMeshGenerator instead of building the grid again, a 16 byte little
+# endian header (magic, format version, flags, nodeCount, gridSize)
+# followed per cell by a flags byte (GRID_NODE, GRID_OPEN), then an
+# int32 node number and 10 float64 (4 x and 4 z corners, y, height)
+# per cell, then the gridSize + 1 int64 byte offsets of the grid rows
+# in the cached .csv
+GRID_MAGIC = b'PGRD'
+GRID_VERSION = 1
+GRID_HEADER = struct.Struct('<4sHHII')
+GRID_EXTENSION = '.grid'
+
+# Cell flags, the cell has a node, and the node is not blocked
+GRID_NODE = 1
+GRID_OPEN = 2
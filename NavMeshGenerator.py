@@ -1,14 +1,36 @@
 from panda3d.egg import EggPolygon, EggGroupNode, EggVertexPool, EggData, EggVertex, loadEggData, EggCoordinateSystem
+from panda3d.core import StringStream
 from GridNode import *
-from math import sqrt
+from NavMeshFormat import BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, binaryNeighborsOffset
+from NavMeshFormat import GRID_HEADER, GRID_MAGIC, GRID_VERSION, GRID_EXTENSION, GRID_NODE, GRID_OPEN
+from math import sqrt, floor, ceil, tan, radians
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import sys
+import os
+
+# Corner vertices closer than this are treated as the same point
+VERTEX_KEY_PRECISION = 10000.0
+
+# Row written for blocked cells and missing neighbors
+CSV_NULL_ROW = '1,1,0,0,0,0,0,0,0,0\n'
+CSV_WRITE_BUFFER = 1 << 20
+
+# Bump when the generated output changes so cached navmeshes are rebuilt
+CACHE_FORMAT = 'navmesh.csv 1'
+
+# Steepest terrain slope (degrees) a cell can have and stay walkable
+MAX_SLOPE = 45.0
 
  
 class NavMeshGenerator():
-    def __init__(self, prim_1_name, prim_2_name):
+    def __init__(self, prim_1_name = None, prim_2_name = None, cache = None, parallel = False, terrain = None, maxSlope = MAX_SLOPE):
 
-        self.oldList = []
-        self.oldCollList = []
+        # Full nodes indexed by corner keys, and the
+        # corner signatures of every Coll quad
+        self.colIndex = {}
+        self.rowIndex = {}
+        self.collSignatures = set()
         
         self.newList = []
         self.newCollList = []
@@ -20,47 +42,359 @@ class NavMeshGenerator():
         self.firstNode = None
         self.lowestVertex = -1
         
-        # Process the egg file and iterate 
-        # through it
-        self.egg = EggData()
-        self.fname = prim_1_name
-        self.egg.resolveEggFilename(self.fname) 
-        self.egg.read(self.fname, "Full")
+        # Set when navmesh.csv was reused from a NavMeshCache,
+        # the grid lists are left empty in that case, ensureGrid()
+        # loads them from the grid side-file of the (cache, key)
+        # entry, or builds them again from sourceInputs
+        self.cacheHit = False
+        self.cacheEntry = None
+        self.sourceInputs = None
         
-        self.eggColl = EggData()
-        self.cname = prim_2_name
-        self.eggColl.resolveEggFilename(self.cname) 
-        self.eggColl.read(self.cname, "Coll")
+        # Byte offset of each grid row in the written .csv
+        self.csvFilename = None
+        self.csvRowOffsets = []
+        
+        # Last written binary navmesh, patched in place on changes
+        self.binaryFilename = None
+        
+        # Bumped on every change to the blocked cells, listeners
+        # are called as listener(navmesh, cells) with the cells
+        # whose neighbor links changed
+        self.version = 0
+        self.changeListeners = []
+        
+        # The grid is filled in by a builder such as fromGrid()
+        if prim_1_name == None:
+            return
+        
+        if not(cache == None):
+            key = cache.makeKey(CACHE_FORMAT, "egg", self.eggBytes(prim_1_name), self.eggBytes(prim_2_name),
+                                *self.terrainKey(terrain, maxSlope))
+            if self.fetchCached(cache, key):
+                self.sourceInputs = ("egg", prim_1_name, prim_2_name, parallel, terrain, maxSlope)
+                return
+        
+        self.createEggGrid(prim_1_name, prim_2_name, parallel, terrain, maxSlope)
+        
+        print("Write to csv file...")
+        self.writeToCSV()
+        
+        if not(cache == None):
+            cache.store(key, 'navmesh.csv')
+            cache.storeSide(key, GRID_EXTENSION, self.writeGrid)
+    
+    # Build the navmesh straight from grid dimensions,
+    # skipping the .egg write, parse and reordering passes
+    # blocked[r][c] is truthy for cells agents cannot enter,
+    # nested lists or a NumPy mask (see WallRasterizer)
+    # with terrain (a HeightSampler) the cells get their terrain
+    # heights and cells steeper than maxSlope degrees are blocked,
+    # without it every cell is flat at height 0
+    @classmethod
+    def fromGrid(cls, gridSize, scale = 1, blocked = None, cache = None, terrain = None, maxSlope = MAX_SLOPE):
+        navmesh = cls()
+        
+        if not(cache == None):
+            mask = b''
+            if not(blocked is None):
+                mask = bytes(bool(blocked[r][c]) for r in range(gridSize) for c in range(gridSize))
+            key = cache.makeKey(CACHE_FORMAT, "grid", gridSize, float(scale), mask,
+                                *navmesh.terrainKey(terrain, maxSlope))
+            if navmesh.fetchCached(cache, key):
+                navmesh.sourceInputs = ("grid", gridSize, scale, blocked, terrain, maxSlope)
+                return navmesh
+        
+        navmesh.createGrid(gridSize, scale, blocked, terrain, maxSlope)
+        
+        print("Write to csv file...")
+        navmesh.writeToCSV()
+        
+        if not(cache == None):
+            cache.store(key, 'navmesh.csv')
+            cache.storeSide(key, GRID_EXTENSION, navmesh.writeGrid)
         
-        print("Creating full node list...")
-        self.iterateEggPoly(self.egg, "Full")
+        return navmesh
+    
+    # Build the grid from the Full and Coll eggs
+    def createEggGrid(self, prim_1_name, prim_2_name, parallel, terrain = None, maxSlope = MAX_SLOPE):
+        self.fname = prim_1_name
+        self.cname = prim_2_name
+        self.egg = None
+        self.eggColl = None
         
-        print("Correcting full node list...")
-        self.createNewFullList()
+        # Worker processes are opt in, they import the launching
+        # script again, which has to guard its start up with
+        # __name__ == "__main__", and only pay off with more
+        # than one core
+        parallel = parallel and (os.cpu_count() or 1) > 1
         
-        print("Creating coll node list...")
-        self.iterateEggPoly(self.eggColl, "Coll")
+        if parallel and not isinstance(prim_1_name, (EggData, array)) and not isinstance(prim_2_name, (EggData, array)):
+            # Both egg files are read and walked at the same
+            # time in worker processes, which hand back flat arrays
+            with ProcessPoolExecutor(2) as pool:
+                fullQuads = pool.submit(readEggQuads, prim_1_name, "Full")
+                collQuads = pool.submit(readEggQuads, prim_2_name, "Coll")
+                
+                print("Creating full node list...")
+                self.ingestQuads(fullQuads.result(), "Full")
+                
+                print("Correcting full node list...")
+                self.createNewFullList()
+                
+                print("Creating coll node list...")
+                self.ingestQuads(collQuads.result(), "Coll")
+        else:
+            # Process the egg file and iterate through it, in-memory
+            # EggData and flat quad arrays are used as is
+            self.egg = self.loadEgg(prim_1_name, "Full")
+            self.eggColl = self.loadEgg(prim_2_name, "Coll")
+            
+            print("Creating full node list...")
+            self.iterateEggPoly(self.egg, "Full")
+            
+            print("Correcting full node list...")
+            self.createNewFullList()
+            
+            print("Creating coll node list...")
+            self.iterateEggPoly(self.eggColl, "Coll")
         
         print("Creating a proper grid with collisions...")
         self.createCombinedGrid()
         
+        if not(terrain == None):
+            print("Sampling terrain heights...")
+            self.applyTerrain(terrain, maxSlope)
+        
         print("Creating neighbors for the grid...")
         self.createNeighbors()
+    
+    # Build the grid straight from its dimensions
+    def createGrid(self, gridSize, scale, blocked, terrain = None, maxSlope = MAX_SLOPE):
+        print("Creating grid directly...")
+        self.createDirectGrid(gridSize, scale, blocked)
         
-        print("Write to csv file...")
-        self.writeToCSV()
+        if not(terrain == None):
+            print("Sampling terrain heights...")
+            self.applyTerrain(terrain, maxSlope)
+        
+        print("Creating neighbors for the grid...")
+        self.createNeighbors()
+    
+    # Build the in-memory grid of a navmesh that was reused from
+    # the cache, the .csv is left as it is, so later updates only
+    # patch its rows
+    def ensureGrid(self):
+        if self.sourceInputs == None:
+            return len(self.finalList) > 0
+        
+        inputs = self.sourceInputs
+        self.sourceInputs = None
+        cache, key = self.cacheEntry
+        if self.loadGrid(cache.sidePath(key, GRID_EXTENSION)):
+            return True
+        
+        # Entries cached without a grid side-file are built
+        # once more and get one for the next time
+        if inputs[0] == "egg":
+            self.createEggGrid(*inputs[1:])
+        else:
+            self.createGrid(*inputs[1:])
+        
+        self.csvFilename = 'navmesh.csv'
+        self.csvRowOffsets = self.readCSVRowOffsets(self.csvFilename)
+        cache.storeSide(key, GRID_EXTENSION, self.writeGrid)
+        return True
+    
+    # Build a large navmesh in square tiles of tileSize cells,
+    # each generated on its own (in worker processes with parallel
+    # on several cores) and stitched to its neighbors through a
+    # one cell border, only one band of tiles is held in memory
+    # and the grid lists are left empty, so the result is CSV only:
+    # it cannot be edited with addObstacle, written as binary or
+    # handed to PathFinder.fromNavMesh, use PathFinder.fromCSV
+    # with perTile the tiles go to navmesh_tile_<row>_<col>.csv
+    # files instead of one merged navmesh.csv
+    @classmethod
+    def fromGridTiled(cls, gridSize, scale = 1, blocked = None, tileSize = 256, perTile = False, parallel = False):
+        navmesh = cls()
+        navmesh.nodeCount = gridSize * gridSize
+        parallel = parallel and (os.cpu_count() or 1) > 1
+        
+        print("Creating grid in tiles...")
+        bands = navmesh.iterTileBands(gridSize, scale, blocked, tileSize, parallel)
+        
+        if perTile:
+            for r0, tiles in bands:
+                for c0, tileRows in tiles:
+                    rows = min(tileSize, gridSize - r0)
+                    cols = min(tileSize, gridSize - c0)
+                    filename = 'navmesh_tile_' + str(r0 // tileSize) + '_' + str(c0 // tileSize) + '.csv'
+                    with open(filename, 'wb', buffering = CSV_WRITE_BUFFER) as file:
+                        file.write(bytes('Grid Size,' + str(gridSize), 'utf-8'))
+                        file.write(bytes('\nTile,' + str(r0) + ',' + str(c0) + ',' + str(rows) + ',' + str(cols), 'utf-8'))
+                        file.write(b'\nNULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ')
+                        file.write(b'\n')
+                        file.write(bytes(''.join(tileRows), 'utf-8'))
+        else:
+            with open('navmesh.csv', 'wb', buffering = CSV_WRITE_BUFFER) as file:
+                file.write(bytes('Grid Size,' + str(gridSize), 'utf-8'))
+                file.write(b'\nNULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ')
+                file.write(b'\n')
+                
+                # Interleave the tiles of a band one grid row at a time
+                for r0, tiles in bands:
+                    for i in range(len(tiles[0][1])):
+                        file.write(bytes(''.join(tileRows[i] for c0, tileRows in tiles), 'utf-8'))
+        
+        return navmesh
+    
+    # Yield (r0, [(c0, tileRows), ...]) for each band of tiles,
+    # the next band is already being generated while one is written
+    def iterTileBands(self, gridSize, scale, blocked, tileSize, parallel):
+        bandStarts = list(range(0, gridSize, tileSize))
+        
+        if not parallel:
+            for r0 in bandStarts:
+                yield r0, [(args[3], generateTile(*args)) for args in self.tileArgs(gridSize, scale, blocked, r0, tileSize)]
+            return
+        
+        with ProcessPoolExecutor() as pool:
+            pending = None
+            for r0 in bandStarts + [None]:
+                submitted = None
+                if not(r0 == None):
+                    submitted = (r0, [(args[3], pool.submit(generateTile, *args))
+                                      for args in self.tileArgs(gridSize, scale, blocked, r0, tileSize)])
+                if not(pending == None):
+                    yield pending[0], [(c0, future.result()) for c0, future in pending[1]]
+                pending = submitted
+    
+    # Arguments of generateTile for each tile in the band starting
+    # at row r0, with the blocked mask cut down to the tile and its border
+    def tileArgs(self, gridSize, scale, blocked, r0, tileSize):
+        args = []
+        wr0 = max(r0 - 1, 0)
+        wr1 = min(r0 + tileSize + 1, gridSize)
+        for c0 in range(0, gridSize, tileSize):
+            window = None
+            if not(blocked is None):
+                wc0 = max(c0 - 1, 0)
+                wc1 = min(c0 + tileSize + 1, gridSize)
+                window = (wr0, wc0, [[bool(blocked[r][c]) for c in range(wc0, wc1)] for r in range(wr0, wr1)])
+            args.append((gridSize, scale, r0, c0, tileSize, window))
+        return args
+    
+    # Generate the .csv rows of one tile, one string per grid row,
+    # window holds the blocked mask of the tile and its border
+    # as (first row, first col, mask rows)
+    def createTileRows(self, gridSize, scale, r0, c0, tileSize, window):
+        r1 = min(r0 + tileSize, gridSize)
+        c1 = min(c0 + tileSize, gridSize)
+        
+        # Formatted (main, neighbor) rows of the open cells
+        cells = {}
+        for r in range(max(r0 - 1, 0), min(r1 + 1, gridSize)):
+            for c in range(max(c0 - 1, 0), min(c1 + 1, gridSize)):
+                if window == None or not window[2][r - window[0]][c - window[1]]:
+                    node = self.gridCellNode(r * gridSize + c, r, c, scale)
+                    node.setRC(r, c)
+                    cells[(r, c)] = self.formatCSVRows(node)
+        
+        tileRows = []
+        for r in range(r0, r1):
+            rows = []
+            for c in range(c0, c1):
+                if not((r, c) in cells):
+                    rows.append(CSV_NULL_ROW)
+                    continue
+                
+                rows.append(cells[(r, c)][0])
+                for cell in self.neighborCells(r, c, gridSize):
+                    if cell == None or not(cell in cells):
+                        rows.append(CSV_NULL_ROW)
+                    else:
+                        rows.append(cells[cell][1])
+            tileRows.append(''.join(rows))
+        
+        return tileRows
+    
+    # Read an egg file, or pass through in-memory EggData
+    # and flat quad arrays
+    def loadEgg(self, prim_name, type):
+        if isinstance(prim_name, (EggData, array)):
+            return prim_name
+        
+        egg = EggData()
+        egg.resolveEggFilename(prim_name) 
+        egg.read(prim_name, type)
+        return egg
+    
+    # Raw egg contents used to key the navmesh cache
+    def eggBytes(self, prim_name):
+        if isinstance(prim_name, EggData):
+            stream = StringStream()
+            prim_name.writeEgg(stream)
+            return stream.getData()
+        
+        if isinstance(prim_name, array):
+            return prim_name.tobytes()
+        
+        with open(prim_name, 'rb') as file:
+            return file.read()
+    
+    # Reuse a cached navmesh.csv when one matches key
+    def fetchCached(self, cache, key):
+        if cache.fetch(key, 'navmesh.csv'):
+            print("Reusing cached navmesh...")
+            self.cacheHit = True
+            self.cacheEntry = (cache, key)
+        
+        return self.cacheHit
     
-    # Iterate through the Egg file and
-    # extracts all the quads and stores them
-    # as nodes
+    # Walk the Egg tree without recursion and
+    # yield its polygons as a stream, in file order
+    def iterEggPolygons(self, egg):
+        stack = [iter([egg])]
+        while len(stack) > 0:
+            child = next(stack[-1], None)
+            if child == None:
+                stack.pop()
+                continue
+            
+            if isinstance(child, EggPolygon):
+                yield child
+            
+            if isinstance(child, EggGroupNode):
+                stack.append(iter(child.getChildren()))
+    
+    # Yield the corner X and Z coordinates of each quad
+    def iterEggQuads(self, egg):
+        for poly in self.iterEggPolygons(egg):
+            pos = [poly.getVertex(i).getPos4() for i in range(4)]
+            yield tuple(v.getX() for v in pos), tuple(v.getZ() for v in pos)
+    
+    # Iterate through the Egg file and extract all
+    # the quads as nodes, indexing each one as it arrives
     def iterateEggPoly(self, egg, type): 
-      # Create a node for each quad
-      if isinstance(egg, EggPolygon):
-        node = GridNode(self.nodeCount, egg.getVertex(0), egg.getVertex(1), 
-                    egg.getVertex(2), egg.getVertex(3))
+        if isinstance(egg, array):
+            self.ingestQuads(egg, type)
+            return
+        
+        for x, z in self.iterEggQuads(egg):
+            self.addQuad(x, z, type)
+    
+    # Extract the quads from a flat array of
+    # four X then four Z coordinates per quad
+    def ingestQuads(self, quads, type):
+        for i in range(0, len(quads), 8):
+            self.addQuad(tuple(quads[i:i+4]), tuple(quads[i+4:i+8]), type)
+    
+    # Store a quad as a node
+    def addQuad(self, x, z, type):
+        # Create a node for each quad
+        node = GridNode(self.nodeCount, x, z)
         
         if type == "Full":
-            self.oldList.append(node)
             # Find the correct vertex number to use
             if (self.lowestVertex == -1):
                  self.analyzeVertex(node)        
@@ -69,23 +403,26 @@ class NavMeshGenerator():
             if (self.firstNode == None):
                 self.firstNode = node             
             else:
-                if node.vertex[self.lowestVertex].getX() < self.firstNode.vertex[self.lowestVertex].getX() and node.vertex[self.lowestVertex].getZ() < self.firstNode.vertex[self.lowestVertex].getZ():
+                if node.x[self.lowestVertex] < self.firstNode.x[self.lowestVertex] and node.z[self.lowestVertex] < self.firstNode.z[self.lowestVertex]:
                     self.firstNode = node
+            
+            # Index the node by its quantized corner vertices
+            # so each neighbor lookup is a single dict hit
+            lowest = self.vertexKey(node, self.lowestVertex)
+            self.colIndex[(lowest, self.vertexKey(node, self.topVertex))] = node
+            self.rowIndex[(self.vertexKey(node, self.rightVertex), lowest)] = node
              
             self.nodeCount = self.nodeCount + 1
         else:
-            self.oldCollList.append(node)
+            self.collSignatures.add(self.quadKey(node))
             self.collNodeCount = self.collNodeCount + 1
-
-      if isinstance(egg, EggGroupNode): 
-        child = egg.getFirstChild() 
-        while child != None: 
-          self.iterateEggPoly(child, type)
-          child = egg.getNextChild()
         
     # Create a new List which has the correctly
     # ordered nodes for the Full nodes
     def createNewFullList(self):
+        colIndex = self.colIndex
+        rowIndex = self.rowIndex
+        
         # Find the next node based on edge 0-3
         currentRowNode = self.firstNode
         currentColNode = self.firstNode
@@ -95,12 +432,9 @@ class NavMeshGenerator():
             nextColNode = None
             for c in range(int(sqrt(self.nodeCount))-1): #sqrt
                 # Processing next col
-                for i in range(self.nodeCount):
-                    try:
-                        if currentColNode.vertex[self.rightVertex] == self.oldList[i].vertex[self.lowestVertex] and currentColNode.vertex[self.toprightVertex] == self.oldList[i].vertex[self.topVertex]:
-                                nextColNode = self.oldList[i]
-                    except:
-                        pass
+                if not(currentColNode == None):
+                    nextColNode = colIndex.get((self.vertexKey(currentColNode, self.rightVertex),
+                                                self.vertexKey(currentColNode, self.toprightVertex)), nextColNode)
                 self.newList.append(nextColNode)
                 currentColNode = nextColNode
 
@@ -109,17 +443,37 @@ class NavMeshGenerator():
                 break
             
             nextRowNode = None
-            for i in range(self.nodeCount):
-                try:
-                    if currentRowNode.vertex[self.toprightVertex] == self.oldList[i].vertex[self.rightVertex] and currentRowNode.vertex[self.topVertex] == self.oldList[i].vertex[self.lowestVertex]:
-                        nextRowNode = self.oldList[i]
-                except:
-                    pass
+            if not(currentRowNode == None):
+                nextRowNode = rowIndex.get((self.vertexKey(currentRowNode, self.toprightVertex),
+                                            self.vertexKey(currentRowNode, self.topVertex)))
             self.newList.append(nextRowNode)
             currentRowNode = nextRowNode
             currentColNode = nextRowNode
 
     
+    # Create the ordered and combined Lists directly
+    def createDirectGrid(self, gridSize, scale, blocked):
+        self.lowestVertex = 0
+        self.rightVertex = 1
+        self.toprightVertex = 2
+        self.topVertex = 3
+        
+        for r in range(gridSize):
+            temp = []
+            self.finalList.append(temp)
+            for c in range(gridSize):
+                node = self.gridCellNode(self.nodeCount, r, c, scale)
+                self.newList.append(node)
+                self.nodeCount = self.nodeCount + 1
+                
+                if blocked is None or not blocked[r][c]:
+                    temp.append(node)
+                else:
+                    temp.append(None)
+        
+        if self.nodeCount > 0:
+            self.firstNode = self.newList[0]
+    
     # Create a combined List which has the correctly
     # ordered nodes with collisions as None           
     def createCombinedGrid(self):
@@ -133,6 +487,58 @@ class NavMeshGenerator():
                 else:
                     self.finalList[r].append(None)
     
+    # Sample the terrain under every open cell in one batch, each cell
+    # gets the height at its center and how far the terrain rises
+    # across it, cells where the terrain between the center and an
+    # edge is steeper than maxSlope degrees are blocked, cells off
+    # the terrain stay flat
+    def applyTerrain(self, terrain, maxSlope = MAX_SLOPE):
+        cells = [(r, c) for r, row in enumerate(self.finalList) for c, node in enumerate(row) if not(node == None)]
+        
+        # Center, then left, right, bottom and top edge midpoints
+        xs = array('d')
+        ys = array('d')
+        for r, c in cells:
+            node = self.finalList[r][c]
+            x0, x1 = min(node.x), max(node.x)
+            z0, z1 = min(node.z), max(node.z)
+            cx = (x0 + x1) / 2
+            cz = (z0 + z1) / 2
+            xs.extend((cx, x0, x1, cx, cx))
+            ys.extend((cz, cz, cz, z0, z1))
+        
+        heights = list(terrain.heightsAt(xs, ys))
+        limit = tan(radians(maxSlope))
+        
+        blocked = 0
+        for i, (r, c) in enumerate(cells):
+            node = self.finalList[r][c]
+            center = heights[i * 5]
+            # NaN is off the terrain
+            if not(center == center):
+                continue
+            
+            # Rise over the half cell from the center to each edge
+            halfX = (max(node.x) - min(node.x)) / 2
+            halfZ = (max(node.z) - min(node.z)) / 2
+            low = high = center
+            steepest = 0.0
+            for h, run in zip(heights[i * 5 + 1:i * 5 + 5], (halfX, halfX, halfZ, halfZ)):
+                if h == h:
+                    low = min(low, h)
+                    high = max(high, h)
+                    if run > 0:
+                        steepest = max(steepest, abs(h - center) / run)
+            
+            node.y = center
+            node.height = high - low
+            
+            if steepest > limit:
+                self.finalList[r][c] = None
+                blocked = blocked + 1
+        
+        print("Blocked " + str(blocked) + " cells steeper than " + str(maxSlope) + " degrees...")
+    
     # Create neighbor lists for each node
     def createNeighbors(self):
         for r in range(int(sqrt(self.nodeCount))): 
@@ -140,125 +546,453 @@ class NavMeshGenerator():
             self.setNeighbors(self.finalList[r][c], r, c)
  
     # Write the grid in the correct format to the .csv
-    def writeToCSV(self):
-        file = open('navmesh.csv', 'wb')
+    # each node is formatted once and the rows of a grid
+    # row are emitted together in a single bulk write
+    def writeToCSV(self, filename = 'navmesh.csv'):
+        gridSize = int(sqrt(self.nodeCount))
         
-        # Grid Size
-        file.write(bytes('Grid Size,', 'utf-8'))
-        file.write(bytes(str(int(sqrt(self.nodeCount))), 'utf-8'))
-        file.write(b'\nNULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ')
-        file.write(b'\n')
+        # Formatted (main, neighbor) rows per grid row, only the
+        # rows around the one being written are kept in memory
+        rowCache = {}
         
-        for r in range(int(sqrt(self.nodeCount))): 
-          for c in range(int(sqrt(self.nodeCount))):
-            node = self.finalList[r][c]
+        with open(filename, 'wb', buffering = CSV_WRITE_BUFFER) as file:
+            # Grid Size
+            file.write(bytes('Grid Size,' + str(gridSize), 'utf-8'))
+            file.write(b'\nNULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ')
+            file.write(b'\n')
+            
+            self.csvFilename = filename
+            self.csvRowOffsets = [file.tell()]
+            for r in range(gridSize):
+                file.write(bytes(self.formatCSVGridRow(r, rowCache), 'utf-8'))
+                rowCache.pop(r - 2, None)
+                self.csvRowOffsets.append(file.tell())
+    
+    # Write the grid as a binary navmesh (see NavMeshFormat),
+    # much smaller than the .csv and loaded by PathFinder.fromBinary()
+    # without parsing, the .csv is still needed by PandAI
+    def writeToBinary(self, filename = 'navmesh.nav'):
+        # A cache hit builds the grid now, tiled navmeshes have none
+        if not self.ensureGrid():
+            raise ValueError('navmesh has no grid in memory to write as binary')
+        
+        gridSize = len(self.finalList)
+        walkable, neighbors = self.gridArrays()
+        if sys.byteorder == 'big':
+            neighbors.byteswap()
+        
+        with open(filename, 'wb') as file:
+            file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, gridSize, *self.gridPlacement()))
+            file.write(walkable)
+            file.write(bytes(binaryNeighborsOffset(gridSize) - file.tell()))
+            file.write(neighbors.tobytes())
+        
+        self.binaryFilename = filename
+    
+    # Write the grid and the byte offsets of its rows in the last
+    # written .csv as a grid side-file (see NavMeshFormat), read
+    # back by loadGrid() when the .csv is reused from the cache
+    def writeGrid(self, filename):
+        gridSize = len(self.finalList)
+        cellCount = gridSize * gridSize
+        flags = bytearray(cellCount)
+        nodeNos = array('i', bytes(4 * cellCount))
+        values = array('d', bytes(8 * 10 * cellCount))
+        
+        for cell, node in enumerate(self.newList[:cellCount]):
             if node == None:
-                file.write(b'1,1,0,0,0,0,0,0,0,0')
-                file.write(b'\n')
-            else:
-                ## For the nodes                
-                # NULL
-                file.write(bytes(str('0' + ','), 'utf-8'))
-                # Node Type (Main)
-                file.write(bytes(str('0' + ','), 'utf-8'))
-                # Grid X
-                file.write(bytes(str(str(node.r) + ','), 'utf-8'))
-                # Grid Y
-                file.write(bytes(str(str(node.c) + ','), 'utf-8'))
-                # Length
-                file.write(bytes(str(str(round(abs(node.vertex[0].getX() - node.vertex[1].getX()), 4)) + ','), 'utf-8'))
-                # Width
-                file.write(bytes(str(str(round(abs(node.vertex[0].getZ() - node.vertex[3].getZ()), 4)) + ','), 'utf-8'))
-                # Height
-                file.write(bytes(str('0' + ',' ), 'utf-8'))
-                # PosX
-                file.write(bytes(str(str(round((node.vertex[0].getX() + node.vertex[1].getX())/2, 4)) + ','), 'utf-8'))
-                # PosY
-                file.write(bytes(str(str(round((node.vertex[0].getZ() + node.vertex[3].getZ())/2, 4)) + ','), 'utf-8'))
-                # PosZ
-                file.write(b'0')
+                continue
+            r, c = divmod(cell, gridSize)
+            flags[cell] = GRID_NODE
+            if self.finalList[r][c] is node:
+                flags[cell] = GRID_NODE | GRID_OPEN
+            nodeNos[cell] = node.nodeNo
+            values[cell * 10:cell * 10 + 10] = array('d', tuple(node.x) + tuple(node.z) + (node.y, node.height))
+        
+        offsets = array('q', self.csvRowOffsets)
+        if sys.byteorder == 'big':
+            nodeNos.byteswap()
+            values.byteswap()
+            offsets.byteswap()
+        
+        with open(filename, 'wb') as file:
+            file.write(GRID_HEADER.pack(GRID_MAGIC, GRID_VERSION, 0, self.nodeCount, gridSize))
+            file.write(flags)
+            file.write(nodeNos.tobytes())
+            file.write(values.tobytes())
+            file.write(offsets.tobytes())
+    
+    # Load the grid from a grid side-file written by writeGrid(),
+    # the .csv it was written with is taken to be navmesh.csv,
+    # returns False when there is no valid side-file
+    def loadGrid(self, filename):
+        if filename == None or not os.path.isfile(filename):
+            return False
+        
+        with open(filename, 'rb') as file:
+            data = file.read()
+        if len(data) < GRID_HEADER.size:
+            return False
+        
+        magic, version, fileFlags, nodeCount, gridSize = GRID_HEADER.unpack_from(data)
+        cellCount = gridSize * gridSize
+        if not(magic == GRID_MAGIC and version == GRID_VERSION):
+            return False
+        if not(len(data) == GRID_HEADER.size + cellCount * 85 + (gridSize + 1) * 8):
+            return False
+        
+        start = GRID_HEADER.size
+        flags = data[start:start + cellCount]
+        start = start + cellCount
+        nodeNos = array('i', data[start:start + 4 * cellCount])
+        start = start + 4 * cellCount
+        values = array('d', data[start:start + 80 * cellCount])
+        start = start + 80 * cellCount
+        offsets = array('q', data[start:])
+        if sys.byteorder == 'big':
+            nodeNos.byteswap()
+            values.byteswap()
+            offsets.byteswap()
+        
+        print("Loading cached navmesh grid...")
+        nodeNos = nodeNos.tolist()
+        values = values.tolist()
+        # Corner tuples, center height and rise of every cell
+        xs = list(zip(values[0::10], values[1::10], values[2::10], values[3::10]))
+        zs = list(zip(values[4::10], values[5::10], values[6::10], values[7::10]))
+        ys = values[8::10]
+        heights = values[9::10]
+        for r in range(gridSize):
+            temp = []
+            self.finalList.append(temp)
+            for c in range(gridSize):
+                cell = r * gridSize + c
+                node = None
+                if flags[cell] & GRID_NODE:
+                    node = GridNode(nodeNos[cell], xs[cell], zs[cell])
+                    node.y = ys[cell]
+                    node.height = heights[cell]
+                self.newList.append(node)
                 
-                file.write(b'\n')
+                if flags[cell] & GRID_OPEN:
+                    temp.append(node)
+                else:
+                    temp.append(None)
+        
+        self.nodeCount = nodeCount
+        if cellCount > 0:
+            self.firstNode = self.newList[0]
+        self.createNeighbors()
+        
+        self.csvFilename = 'navmesh.csv'
+        self.csvRowOffsets = offsets.tolist()
+        return True
+    
+    # Find the byte offset of every grid row in a .csv written
+    # by writeToCSV() from the current grid, a cell has a main row
+    # and 8 neighbor rows, or a single null row when blocked
+    def readCSVRowOffsets(self, filename):
+        offsets = []
+        with open(filename, 'rb') as file:
+            # Grid size and column names
+            offset = len(file.readline()) + len(file.readline())
+            for row in self.finalList:
+                offsets.append(offset)
+                lines = sum(1 if node == None else 9 for node in row)
+                for i in range(lines):
+                    offset = offset + len(file.readline())
+        offsets.append(offset)
+        return offsets
+    
+    # Rewrite the walkable byte and neighbors of the given
+    # (row, col) cells in the last written binary navmesh
+    def updateBinaryCells(self, cells):
+        if self.binaryFilename == None:
+            return
+        
+        gridSize = len(self.finalList)
+        offset = binaryNeighborsOffset(gridSize)
+        with open(self.binaryFilename, 'r+b') as file:
+            for r, c in sorted(cells):
+                node = self.finalList[r][c]
+                cellNeighbors = array('i', [-1]) * 8
+                if not(node == None):
+                    for i, nnode in enumerate(node.neighbors):
+                        if not(nnode == None):
+                            cellNeighbors[i] = nnode.r * gridSize + nnode.c
+                if sys.byteorder == 'big':
+                    cellNeighbors.byteswap()
+                
+                file.seek(BINARY_HEADER.size + r * gridSize + c)
+                file.write(bytes([not(node == None)]))
+                file.seek(offset + (r * gridSize + c) * 32)
+                file.write(cellNeighbors.tobytes())
+    
+    # Rewrite only the given grid rows of the last written .csv,
+    # rows before the first dirty one are left untouched on disk
+    def updateCSVRows(self, dirtyRows):
+        if self.csvFilename == None or len(self.csvRowOffsets) == 0:
+            self.writeToCSV()
+            return
+        
+        if len(dirtyRows) == 0:
+            return
+        
+        first = min(dirtyRows)
+        last = max(dirtyRows)
+        offsets = self.csvRowOffsets
+        rowCache = {}
+        
+        with open(self.csvFilename, 'r+b') as file:
+            chunks = []
+            for r in range(first, last + 1):
+                if r in dirtyRows:
+                    chunks.append(bytes(self.formatCSVGridRow(r, rowCache), 'utf-8'))
+                else:
+                    file.seek(offsets[r])
+                    chunks.append(file.read(offsets[r + 1] - offsets[r]))
+            file.seek(offsets[last + 1])
+            tail = file.read()
+            
+            file.seek(offsets[first])
+            for chunk in chunks:
+                file.write(chunk)
+            file.write(tail)
+            file.truncate()
+        
+        # Rows after the rewritten span move by the same amount
+        oldEnd = offsets[last + 1]
+        for r in range(first, last + 1):
+            offsets[r + 1] = offsets[r] + len(chunks[r - first])
+        shift = offsets[last + 1] - oldEnd
+        for r in range(last + 2, len(offsets)):
+            offsets[r] = offsets[r] + shift
+    
+    # Format the .csv rows of one grid row, rowCache holds the
+    # formatted (main, neighbor) rows of the grid rows around it
+    def formatCSVGridRow(self, r, rowCache):
+        for nr in range(max(r - 1, 0), min(r + 2, len(self.finalList))):
+            if not(nr in rowCache):
+                rowCache[nr] = [None if node == None else self.formatCSVRows(node) for node in self.finalList[nr]]
+        
+        rows = []
+        for c, node in enumerate(self.finalList[r]):
+            if node == None:
+                rows.append(CSV_NULL_ROW)
+            else:
+                ## For the nodes
+                rows.append(rowCache[r][c][0])
                 
                 ## For the nodes neighbors
-                for i in range(8):
-                    nnode = node.neighbors[i]
+                for nnode in node.neighbors:
                     if nnode == None:
-                        file.write(b'1,1,0,0,0,0,0,0,0,0')
+                        rows.append(CSV_NULL_ROW)
                     else:
-                        # NULL
-                        file.write(bytes(str('0' + ','), 'utf-8'))
-                        # Node Type (Neighbor)
-                        file.write(bytes(str('1' + ','), 'utf-8'))
-                        # Grid X
-                        file.write(bytes(str(str(nnode.r) + ','), 'utf-8'))
-                        # Grid Y
-                        file.write(bytes(str(str(nnode.c) + ','), 'utf-8'))
-                        # Length
-                        file.write(bytes(str(str(round(abs(nnode.vertex[0].getX() - nnode.vertex[1].getX()), 4)) + ','), 'utf-8'))
-                        # Width
-                        file.write(bytes(str(round(nnode.vertex[0].getZ() - nnode.vertex[3].getZ(), 4)) + ',', 'utf-8'))
-                        # Height
-                        file.write(bytes(str('0' + ','), 'utf-8'))
-                        # PosX
-                        file.write(bytes(str(str(round((nnode.vertex[0].getX() + nnode.vertex[1].getX())/2, 4)) + ','), 'utf-8'))
-                        # PosY
-                        file.write(bytes(str(str(round((nnode.vertex[0].getZ() + nnode.vertex[3].getZ())/2, 4)) + ','), 'utf-8'))
-                        # PosZ
-                        file.write(b'0')                    
-                        
-                    file.write(b'\n')
-
+                        rows.append(rowCache[nnode.r][nnode.c][1])
+        
+        return ''.join(rows)
+    
+    # Mark the cells covered by a wall's bounds (world X/Y)
+    # as blocked and refresh only the affected grid rows
+    def addObstacle(self, minX, minY, maxX, maxY):
+        self.ensureGrid()
+        return self.setCellsBlocked(self.cellsInBounds(minX, minY, maxX, maxY), True)
+    
+    # Block or reopen (row, col) cells, relinking only the
+    # neighbors around them and rewriting only their .csv rows
+    def setCellsBlocked(self, cells, blocked = True):
+        if not self.ensureGrid():
+            print("Navmesh grid is not in memory, skipping update...")
+            return 0
+        
+        gridSize = len(self.finalList)
+        changed = 0
+        affected = set()
+        for r, c in cells:
+            node = None
+            if not blocked:
+                node = self.newList[r * gridSize + c]
+            if self.finalList[r][c] is node:
+                continue
+            
+            self.finalList[r][c] = node
+            changed = changed + 1
+            for nr in range(max(r - 1, 0), min(r + 2, gridSize)):
+                for nc in range(max(c - 1, 0), min(c + 2, gridSize)):
+                    affected.add((nr, nc))
+        
+        for r, c in affected:
+            self.setNeighbors(self.finalList[r][c], r, c)
+        
+        self.updateCSVRows(set(r for r, c in affected))
+        self.updateBinaryCells(affected)
+        
+        if changed > 0:
+            self.version = self.version + 1
+            for listener in self.changeListeners:
+                listener(self, affected)
+        return changed
+    
+    # Call listener(navmesh, cells) after every change
+    # to the blocked cells, until it is removed again
+    def addChangeListener(self, listener):
+        self.changeListeners.append(listener)
+    
+    def removeChangeListener(self, listener):
+        if listener in self.changeListeners:
+            self.changeListeners.remove(listener)
+    
+    # Helper function which finds the (row, col) of every
+    # cell overlapping the given world X/Y bounds
+    def cellsInBounds(self, minX, minY, maxX, maxY):
+        gridSize = len(self.finalList)
+        if self.firstNode == None or gridSize == 0:
+            return []
+        
+        originX = min(self.firstNode.x)
+        originZ = min(self.firstNode.z)
+        cellX = max(self.firstNode.x) - originX
+        cellZ = max(self.firstNode.z) - originZ
+        
+        c0 = max(int(floor((minX - originX) / cellX)), 0)
+        c1 = min(int(ceil((maxX - originX) / cellX)), gridSize)
+        r0 = max(int(floor((minY - originZ) / cellZ)), 0)
+        r1 = min(int(ceil((maxY - originZ) / cellZ)), gridSize)
+        return [(r, c) for r in range(r0, r1) for c in range(c0, c1)]
+    
     ## HELPER FUNCTIONS 
     
+    # Helper function which flattens the grid into a walkable byte
+    # and 8 neighbor cell indices (-1 for none) per cell
+    def gridArrays(self):
+        gridSize = len(self.finalList)
+        walkable = bytearray(gridSize * gridSize)
+        neighbors = array('i', [-1]) * (8 * gridSize * gridSize)
+        
+        for row in self.finalList:
+            for node in row:
+                if node == None:
+                    continue
+                cell = node.r * gridSize + node.c
+                walkable[cell] = 1
+                base = cell * 8
+                for i, nnode in enumerate(node.neighbors):
+                    if not(nnode == None):
+                        neighbors[base + i] = nnode.r * gridSize + nnode.c
+        return walkable, neighbors
+    
+    # Helper function which finds the world X/Y of the corner
+    # of cell (0, 0) and the cell length and width
+    def gridPlacement(self):
+        first = self.firstNode
+        if first == None:
+            return (0.0, 0.0, 1.0, 1.0)
+        return (min(first.x), min(first.z), max(first.x) - min(first.x), max(first.z) - min(first.z))
+    
+    # Helper function which formats a node as its main
+    # .csv row and as the row used when it is a neighbor
+    def formatCSVRows(self, node):
+        x = node.x
+        z = node.z
+        # Grid X, Grid Y, Length
+        prefix = str(node.r) + ',' + str(node.c) + ',' + str(round(abs(x[0] - x[1]), 4)) + ','
+        # Height, PosX, PosY, PosZ
+        suffix = (',' + self.formatHeight(node.height) + ',' + str(round((x[0] + x[1])/2, 4)) + ',' +
+                  str(round((z[0] + z[3])/2, 4)) + ',' + self.formatHeight(node.y) + '\n')
+        
+        # NULL, Node Type (Main), ..., Width
+        mainRow = '0,0,' + prefix + str(round(abs(z[0] - z[3]), 4)) + suffix
+        # NULL, Node Type (Neighbor), ..., Width
+        neighborRow = '0,1,' + prefix + str(round(z[0] - z[3], 4)) + suffix
+        
+        return mainRow, neighborRow
+    
+    # Helper function which formats a terrain height,
+    # flat cells keep the plain 0 of the original format
+    def formatHeight(self, height):
+        if height == 0:
+            return '0'
+        return str(round(height, 4))
+    
+    # Helper function which builds the cache key parts of
+    # a terrain, none at all without one
+    def terrainKey(self, terrain, maxSlope):
+        if terrain == None:
+            return ()
+        return ("terrain", terrain.digest(), float(maxSlope))
+    
+    # Helper function which quantizes a node corner into
+    # a hashable key, used to index nodes by their corners
+    def vertexKey(self, node, i):
+        return (round(node.x[i] * VERTEX_KEY_PRECISION), round(node.z[i] * VERTEX_KEY_PRECISION))
+    
+    # Helper function which builds the hashable
+    # signature of a quad from its ordered corners
+    def quadKey(self, node):
+        return tuple(self.vertexKey(node, i) for i in range(4))
+    
     # Helper function which finds collisions
     def CollContains(self, chkNode):
-        for node in self.oldCollList:
-            try:
-                if node.vertex == chkNode.vertex:
-                    return True
-            except:
-                pass
+        if chkNode == None:
+            return False
             
-        return False
+        return self.quadKey(chkNode) in self.collSignatures
     
-    # Helper function which finds collisions
+    # Helper function which links a node to its neighbors
     def setNeighbors(self, node, row, col):
         if not(node == None):
             # Setting the row and col parameters
             node.setRC(row, col)
             
-            # left top 
-            if col>0 and (row+1)<sqrt(self.nodeCount):
-                node.neighbors[0] = self.finalList[row+1][col-1]
+            for i, cell in enumerate(self.neighborCells(row, col, sqrt(self.nodeCount))):
+                if not(cell == None):
+                    node.neighbors[i] = self.finalList[cell[0]][cell[1]]
+    
+    # Helper function which gives the (row, col) of each of
+    # the 8 neighbor slots of a cell, None when off the grid
+    def neighborCells(self, row, col, gridSize):
+        cells = [None] * 8
+        
+        # left top 
+        if col>0 and (row+1)<gridSize:
+            cells[0] = (row+1, col-1)
 
-            # left mid  
-            if col>0:
-                node.neighbors[1] = self.finalList[row][col-1]
+        # left mid  
+        if col>0:
+            cells[1] = (row, col-1)
 
-            # left bot     
-            if col>0 and (row-1)>0:
-                node.neighbors[2] = self.finalList[row-1][col-1]
+        # left bot     
+        if col>0 and (row-1)>0:
+            cells[2] = (row-1, col-1)
 
-            # bot mid
-            if (row-1)>0:
-                node.neighbors[3] = self.finalList[row-1][col]
+        # bot mid
+        if (row-1)>0:
+            cells[3] = (row-1, col)
 
-            # bot right    
-            if (row-1)>0 and (col+1)<sqrt(self.nodeCount):
-                node.neighbors[4] = self.finalList[row-1][col+1]
+        # bot right    
+        if (row-1)>0 and (col+1)<gridSize:
+            cells[4] = (row-1, col+1)
 
-            # right mid   
-            if (col+1)<sqrt(self.nodeCount):
-                node.neighbors[5] = self.finalList[row][col+1]
+        # right mid   
+        if (col+1)<gridSize:
+            cells[5] = (row, col+1)
 
-             # right top    
-            if (row+1)<sqrt(self.nodeCount) and (col+1)<sqrt(self.nodeCount):
-                node.neighbors[6] = self.finalList[row+1][col+1]
+         # right top    
+        if (row+1)<gridSize and (col+1)<gridSize:
+            cells[6] = (row+1, col+1)
 
-            # top mid   
-            if (row+1)<sqrt(self.nodeCount):
-                node.neighbors[7] = self.finalList[row+1][col]
+        # top mid   
+        if (row+1)<gridSize:
+            cells[7] = (row+1, col)
+        
+        return cells
+    
+    # Helper function which creates the node of a grid cell
+    # using the same quad layout as makeSquaresEVPXZ
+    def gridCellNode(self, nodeNo, row, col, scale):
+        x = float(col * scale)
+        z = float(row * scale)
+        return GridNode(nodeNo, (x, x + scale, x + scale, x), (z, z, z + scale, z + scale))
                 
     # Helper function to calculate the correct vertex
     def analyzeVertex(self, node):
@@ -266,16 +1000,16 @@ class NavMeshGenerator():
         self.lowestVertex = 0
         
         for i in range(4):
-            if node.vertex[i].getX() < node.vertex[self.lowestVertex].getX() and node.vertex[i].getZ() < node.vertex[self.lowestVertex].getZ():
+            if node.x[i] < node.x[self.lowestVertex] and node.z[i] < node.z[self.lowestVertex]:
                 self.lowestVertex = i
         
         # top, left, right
         for i in range(4):
             if not(i==self.lowestVertex):
-                x1 = float(int(node.vertex[self.lowestVertex].getX()*precision)/precision)
-                x2 = float(int(node.vertex[i].getX()*precision)/precision)
-                z1 = float(int(node.vertex[self.lowestVertex].getZ()*precision)/precision)
-                z2 = float(int(node.vertex[i].getZ()*precision)/precision)
+                x1 = float(int(node.x[self.lowestVertex]*precision)/precision)
+                x2 = float(int(node.x[i]*precision)/precision)
+                z1 = float(int(node.z[self.lowestVertex]*precision)/precision)
+                z2 = float(int(node.z[i]*precision)/precision)
 
                 if x1 == x2 and z1 < z2:
                     self.topVertex = i
@@ -286,3 +1020,17 @@ class NavMeshGenerator():
                 if x1 < x2 and z1 < z2:
                     self.toprightVertex = i
 
+
+# Worker process entry point, reads one egg file and
+# returns its quads as a flat array of corner coordinates
+def readEggQuads(prim_name, type):
+    navmesh = NavMeshGenerator()
+    quads = array('d')
+    for x, z in navmesh.iterEggQuads(navmesh.loadEgg(prim_name, type)):
+        quads.extend(x)
+        quads.extend(z)
+    return quads
+
+# Worker process entry point, generates the .csv rows of one tile
+def generateTile(gridSize, scale, r0, c0, tileSize, window):
+    return NavMeshGenerator().createTileRows(gridSize, scale, r0, c0, tileSize, window)
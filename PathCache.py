@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+
+class PathCache():
+    # LRU cache in front of a PathFinder, keyed on
+    # (navmesh version, start cell, goal cell), entries from an
+    # older navmesh version are dropped as soon as it changes
+    def __init__(self, finder, maxEntries = 1024):
+        self.finder = finder
+        self.maxEntries = maxEntries
+        self.paths = OrderedDict()
+        self.version = finder.version
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Cached version of PathFinder.findPath
+    def findPath(self, start, goal):
+        return self.findPaths([(start, goal)])[0]
+
+    # Cached version of PathFinder.findPaths, only
+    # the misses are handed on to the finder as one batch
+    def findPaths(self, pairs):
+        if not(self.finder.version == self.version):
+            self.invalidate()
+            self.version = self.finder.version
+
+        keys = [(self.version, tuple(start), tuple(goal)) for start, goal in pairs]
+        results = {}
+        missing = []
+        for key in keys:
+            if key in self.paths:
+                self.hits = self.hits + 1
+                self.paths.move_to_end(key)
+                results[key] = self.paths[key]
+            else:
+                self.misses = self.misses + 1
+                missing.append(key)
+
+        missing = list(dict.fromkeys(missing))
+        found = self.finder.findPaths([(start, goal) for version, start, goal in missing])
+        for key, path in zip(missing, found):
+            results[key] = path
+            self.store(key, path)
+
+        # Copies, so callers consuming a path cannot change the cache
+        return [list(results[key]) for key in keys]
+
+    def store(self, key, path):
+        self.paths[key] = path
+        while len(self.paths) > self.maxEntries:
+            self.paths.popitem(last = False)
+            self.evictions = self.evictions + 1
+
+    # Drop every cached path
+    def invalidate(self):
+        if len(self.paths) > 0:
+            self.invalidations = self.invalidations + 1
+        self.paths.clear()
+
+    # Counters and size for monitoring
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self.paths)}
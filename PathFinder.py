@@ -0,0 +1,564 @@
+from array import array
+from heapq import heappush, heappop
+from math import floor
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import mmap
+import sys
+
+from NavMeshFormat import BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, binaryNeighborsOffset
+
+# Cost of a step through each of the 8 neighbor slots, in the
+# slot order used by NavMeshGenerator.setNeighbors, integer
+# costs like PandAI's keep ties between equal paths exact
+STRAIGHT_COST = 10
+DIAGONAL_COST = 14
+STEP_COSTS = (DIAGONAL_COST, STRAIGHT_COST, DIAGONAL_COST, STRAIGHT_COST,
+              DIAGONAL_COST, STRAIGHT_COST, DIAGONAL_COST, STRAIGHT_COST)
+
+# (row step, col step) of each neighbor slot and the slot of each step
+SLOT_DIRECTIONS = ((1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0))
+DIRECTION_SLOTS = dict((direction, i) for i, direction in enumerate(SLOT_DIRECTIONS))
+
+# Queries handed to a worker process at a time by findPaths
+BATCH_CHUNK = 64
+
+
+class PathFinder():
+    # Headless A* over a navmesh grid, usable without a window,
+    # a scene graph or PandAI
+    # neighbors holds 8 cell indices per cell (-1 for none), cells
+    # are indexed row * gridSize + col
+    def __init__(self, gridSize, neighbors, originX = 0.0, originY = 0.0, cellLength = 1.0, cellWidth = 1.0):
+        self.gridSize = gridSize
+        self.neighbors = neighbors
+
+        # World placement of cell (0, 0) and the cell size
+        self.originX = originX
+        self.originY = originY
+        self.cellLength = cellLength
+        self.cellWidth = cellWidth
+
+        # A cell is walkable when it has a main row in the navmesh
+        cellCount = gridSize * gridSize
+        self.walkable = bytearray(cellCount)
+
+        # Scratch buffers shared by every query, an entry is only
+        # valid when its stamp matches the id of the current search
+        self.searchId = 0
+        self.stamp = array('i', bytes(4 * cellCount))
+        self.closed = array('i', bytes(4 * cellCount))
+        self.gScore = array('i', bytes(4 * cellCount))
+        self.parent = array('i', bytes(4 * cellCount))
+
+        # Cells expanded by the last query
+        self.expanded = 0
+
+        # Answer unbounded queries with Jump Point Search, see findPathJPS()
+        self.jumpPoints = False
+        self.jumpTables = None
+        self.jumpVersion = None
+
+        # Worker processes for findPaths, see startWorkers()
+        self.pool = None
+        self.poolSize = None
+
+        # Version of the navmesh the grid was last synced to,
+        # and the navmesh followed since fromNavMesh() until close()
+        self.version = 0
+        self.navmesh = None
+
+        # Memory-mapped file behind the grid, see fromBinary()
+        self.mapping = None
+
+    # Build from the grid of a NavMeshGenerator, navmeshes that keep
+    # no grid in memory (fromGridTiled) have to be read with fromCSV
+    @classmethod
+    def fromNavMesh(cls, navmesh):
+        if not navmesh.ensureGrid():
+            raise ValueError('navmesh has no grid in memory, load its .csv with PathFinder.fromCSV instead')
+        walkable, neighbors = navmesh.gridArrays()
+        finder = cls(len(navmesh.finalList), neighbors, *navmesh.gridPlacement())
+        finder.walkable = walkable
+
+        # Follow later obstacle changes on the navmesh
+        finder.version = navmesh.version
+        finder.navmesh = navmesh
+        navmesh.addChangeListener(finder.onNavMeshChanged)
+        return finder
+
+    # Stop the workers and stop following the navmesh, the grid
+    # stays as it is, call when the finder is no longer used
+    def close(self):
+        self.stopWorkers()
+        if not(self.navmesh == None):
+            self.navmesh.removeChangeListener(self.onNavMeshChanged)
+            self.navmesh = None
+
+    # Resync the given (row, col) cells after the navmesh changed
+    def onNavMeshChanged(self, navmesh, cells):
+        gridSize = self.gridSize
+        for r, c in cells:
+            cell = r * gridSize + c
+            node = navmesh.finalList[r][c]
+            self.walkable[cell] = not(node == None)
+            for i in range(8):
+                self.neighbors[cell * 8 + i] = -1
+                if not(node == None or node.neighbors[i] == None):
+                    self.neighbors[cell * 8 + i] = node.neighbors[i].r * gridSize + node.neighbors[i].c
+
+        self.version = navmesh.version
+        # Worker copies of the grid are stale now
+        if not(self.pool == None):
+            self.startWorkers(self.poolSize)
+
+    # Build from a navmesh.csv written by NavMeshGenerator
+    @classmethod
+    def fromCSV(cls, filename = 'navmesh.csv'):
+        with open(filename, 'r') as file:
+            gridSize = int(file.readline().split(',')[1])
+            # Column names
+            file.readline()
+
+            neighbors = array('i', [-1]) * (8 * gridSize * gridSize)
+            walkable = bytearray(gridSize * gridSize)
+            placement = None
+
+            for cell in range(gridSize * gridSize):
+                main = file.readline().split(',')
+                # NULL rows stand for blocked cells
+                if main[0] == '1':
+                    continue
+
+                walkable[cell] = 1
+                if placement == None:
+                    r, c = int(main[2]), int(main[3])
+                    length, width = float(main[4]), abs(float(main[5]))
+                    placement = (float(main[7]) - (c + 0.5) * length, float(main[8]) - (r + 0.5) * width, length, width)
+
+                base = cell * 8
+                for i in range(8):
+                    row = file.readline().split(',')
+                    if row[0] == '0':
+                        neighbors[base + i] = int(row[2]) * gridSize + int(row[3])
+
+        if placement == None:
+            placement = (0.0, 0.0, 1.0, 1.0)
+        finder = cls(gridSize, neighbors, *placement)
+        finder.walkable = walkable
+        return finder
+
+    # Build from a binary navmesh written by NavMeshGenerator,
+    # the file is memory-mapped and used as it is, without parsing
+    # the grid is read-only and does not follow later changes
+    @classmethod
+    def fromBinary(cls, filename = 'navmesh.nav'):
+        with open(filename, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, flags, gridSize, originX, originY, cellLength, cellWidth = BINARY_HEADER.unpack_from(mapping)
+        if not(magic == BINARY_MAGIC and version == BINARY_VERSION):
+            mapping.close()
+            raise ValueError(filename + ' is not a version ' + str(BINARY_VERSION) + ' binary navmesh')
+
+        cellCount = gridSize * gridSize
+        offset = binaryNeighborsOffset(gridSize)
+        view = memoryview(mapping)
+        if sys.byteorder == 'little':
+            neighbors = view[offset:offset + 32 * cellCount].cast('i')
+        else:
+            neighbors = array('i')
+            neighbors.frombytes(view[offset:offset + 32 * cellCount])
+            neighbors.byteswap()
+
+        finder = cls(gridSize, neighbors, originX, originY, cellLength, cellWidth)
+        finder.walkable = view[BINARY_HEADER.size:BINARY_HEADER.size + cellCount]
+        # Keep the mapping open as long as the views are used
+        finder.mapping = mapping
+        return finder
+
+    # The (row, col) cell containing world point x, y
+    def cellAt(self, x, y):
+        return (int(floor((y - self.originY) / self.cellWidth)), int(floor((x - self.originX) / self.cellLength)))
+
+    # World x, y of the center of a (row, col) cell
+    def cellCenter(self, cell):
+        return (self.originX + (cell[1] + 0.5) * self.cellLength, self.originY + (cell[0] + 0.5) * self.cellWidth)
+
+    # Find a path between two (row, col) cells, returns the
+    # list of cells from start to goal or [] when there is none
+    # bounds (r0, c0, r1, c1) keeps the search inside those rows/cols
+    def findPath(self, start, goal, bounds = None):
+        if self.jumpPoints and bounds == None:
+            return self.findPathJPS(start, goal)
+
+        gridSize = self.gridSize
+        if not(self.inGrid(start) and self.inGrid(goal)):
+            return []
+
+        startCell = start[0] * gridSize + start[1]
+        goalCell = goal[0] * gridSize + goal[1]
+        if not(self.walkable[startCell] and self.walkable[goalCell]):
+            return []
+
+        searchId = self.nextSearchId()
+        neighbors = self.neighbors
+        stamp = self.stamp
+        closed = self.closed
+        gScore = self.gScore
+        parent = self.parent
+        goalRow, goalCol = goal
+
+        stamp[startCell] = searchId
+        gScore[startCell] = 0
+        parent[startCell] = -1
+        openHeap = [(0, 0, startCell)]
+        expanded = 0
+
+        while len(openHeap) > 0:
+            f, h, cell = heappop(openHeap)
+            if closed[cell] == searchId:
+                continue
+            closed[cell] = searchId
+            expanded = expanded + 1
+
+            if cell == goalCell:
+                self.expanded = expanded
+                return self.tracePath(cell)
+
+            g = gScore[cell]
+            base = cell * 8
+            for i in range(8):
+                nextCell = neighbors[base + i]
+                if nextCell < 0 or closed[nextCell] == searchId:
+                    continue
+                if bounds:
+                    r, c = divmod(nextCell, gridSize)
+                    if r < bounds[0] or c < bounds[1] or r >= bounds[2] or c >= bounds[3]:
+                        continue
+
+                nextG = g + STEP_COSTS[i]
+                if stamp[nextCell] != searchId or nextG < gScore[nextCell]:
+                    stamp[nextCell] = searchId
+                    gScore[nextCell] = nextG
+                    parent[nextCell] = cell
+
+                    # Octile distance to the goal, ties in f
+                    # are broken towards the goal
+                    dr = abs(nextCell // gridSize - goalRow)
+                    dc = abs(nextCell % gridSize - goalCol)
+                    if dr < dc:
+                        h = STRAIGHT_COST * dc + (DIAGONAL_COST - STRAIGHT_COST) * dr
+                    else:
+                        h = STRAIGHT_COST * dr + (DIAGONAL_COST - STRAIGHT_COST) * dc
+                    heappush(openHeap, (nextG + h, h, nextCell))
+
+        self.expanded = expanded
+        return []
+
+    # Jump Point Search version of findPath, the grid has uniform step
+    # costs so straight and diagonal runs through open space are
+    # skipped instead of expanded cell by cell, only the cells where
+    # the route may turn (jump points) go through the open heap
+    # diagonal steps past blocked corners are allowed like in the navmesh
+    # links, and every step is still taken along an existing link
+    # straight runs come from tables built on the first query
+    def findPathJPS(self, start, goal):
+        gridSize = self.gridSize
+        if not(self.inGrid(start) and self.inGrid(goal)):
+            return []
+
+        startCell = start[0] * gridSize + start[1]
+        goalCell = goal[0] * gridSize + goal[1]
+        if not(self.walkable[startCell] and self.walkable[goalCell]):
+            return []
+
+        if self.jumpTables == None or not(self.jumpVersion == self.version):
+            self.buildJumpTables()
+
+        searchId = self.nextSearchId()
+        stamp = self.stamp
+        closed = self.closed
+        gScore = self.gScore
+        parent = self.parent
+        goalRow, goalCol = goal
+
+        stamp[startCell] = searchId
+        gScore[startCell] = 0
+        parent[startCell] = -1
+        openHeap = [(0, 0, startCell)]
+        expanded = 0
+
+        while len(openHeap) > 0:
+            f, h, cell = heappop(openHeap)
+            if closed[cell] == searchId:
+                continue
+            closed[cell] = searchId
+            expanded = expanded + 1
+
+            if cell == goalCell:
+                self.expanded = expanded
+                return self.traceJumps(cell)
+
+            g = gScore[cell]
+            r, c = divmod(cell, gridSize)
+            for dr, dc in self.prunedDirections(cell, r, c):
+                nextCell = self.jump(cell, dr, dc, goalCell)
+                if nextCell < 0 or closed[nextCell] == searchId:
+                    continue
+
+                # Jumps are straight or diagonal runs
+                nr, nc = divmod(nextCell, gridSize)
+                if dr and dc:
+                    nextG = g + DIAGONAL_COST * abs(nr - r)
+                else:
+                    nextG = g + STRAIGHT_COST * (abs(nr - r) + abs(nc - c))
+
+                if stamp[nextCell] != searchId or nextG < gScore[nextCell]:
+                    stamp[nextCell] = searchId
+                    gScore[nextCell] = nextG
+                    parent[nextCell] = cell
+
+                    dr2 = abs(nr - goalRow)
+                    dc2 = abs(nc - goalCol)
+                    if dr2 < dc2:
+                        h = STRAIGHT_COST * dc2 + (DIAGONAL_COST - STRAIGHT_COST) * dr2
+                    else:
+                        h = STRAIGHT_COST * dr2 + (DIAGONAL_COST - STRAIGHT_COST) * dc2
+                    heappush(openHeap, (nextG + h, h, nextCell))
+
+        self.expanded = expanded
+        return []
+
+    # Directions worth searching from a jump point, the natural ones
+    # along the direction it was reached from plus the forced ones
+    # around blocked cells beside it, every direction from the start
+    def prunedDirections(self, cell, r, c):
+        if self.parent[cell] < 0:
+            return SLOT_DIRECTIONS
+
+        pr, pc = divmod(self.parent[cell], self.gridSize)
+        dr = (r > pr) - (r < pr)
+        dc = (c > pc) - (c < pc)
+        isOpen = self.isOpen
+
+        if dr and dc:
+            directions = [(dr, 0), (0, dc), (dr, dc)]
+            if not isOpen(r, c - dc):
+                directions.append((dr, -dc))
+            if not isOpen(r - dr, c):
+                directions.append((-dr, dc))
+        elif dc:
+            directions = [(0, dc)]
+            if not isOpen(r + 1, c):
+                directions.append((1, dc))
+            if not isOpen(r - 1, c):
+                directions.append((-1, dc))
+        else:
+            directions = [(dr, 0)]
+            if not isOpen(r, c + 1):
+                directions.append((dr, 1))
+            if not isOpen(r, c - 1):
+                directions.append((dr, -1))
+        return directions
+
+    # Step from cell in one direction until the goal or a cell with a
+    # forced neighbor is reached, returns that cell or -1 when the run
+    # hits a missing link first, diagonal runs also stop where one of
+    # their straight runs would find a jump point
+    def jump(self, cell, dr, dc, goalCell):
+        if not(dr and dc):
+            return self.jumpStraight(cell, dr, dc, goalCell)
+
+        neighbors = self.neighbors
+        gridSize = self.gridSize
+        isOpen = self.isOpen
+        slot = DIRECTION_SLOTS[(dr, dc)]
+
+        while True:
+            cell = neighbors[cell * 8 + slot]
+            if cell < 0:
+                return -1
+            if cell == goalCell:
+                return cell
+
+            r, c = divmod(cell, gridSize)
+            if (isOpen(r + dr, c - dc) and not isOpen(r, c - dc)) or (isOpen(r - dr, c + dc) and not isOpen(r - dr, c)):
+                return cell
+            if self.jumpStraight(cell, dr, 0, goalCell) >= 0 or self.jumpStraight(cell, 0, dc, goalCell) >= 0:
+                return cell
+
+    # Straight runs are looked up in the jump tables instead of stepped
+    def jumpStraight(self, cell, dr, dc, goalCell):
+        gridSize = self.gridSize
+        steps = self.jumpTables[(dr, dc)][cell]
+
+        # Goal on the run before it stops
+        r, c = divmod(cell, gridSize)
+        goalRow, goalCol = divmod(goalCell, gridSize)
+        toGoal = 0
+        if dr == 0 and goalRow == r:
+            toGoal = (goalCol - c) * dc
+        elif dc == 0 and goalCol == c:
+            toGoal = (goalRow - r) * dr
+        if toGoal > 0 and toGoal <= abs(steps):
+            return goalCell
+
+        if steps > 0:
+            return cell + steps * (dr * gridSize + dc)
+        return -1
+
+    # For each straight direction and cell, the steps to the next jump
+    # point along the run (> 0) or minus the steps to the last cell
+    # before a missing link (<= 0), rebuilt lazily on navmesh changes
+    def buildJumpTables(self):
+        gridSize = self.gridSize
+        neighbors = self.neighbors
+        cellCount = gridSize * gridSize
+
+        self.jumpTables = {}
+        for dr, dc in ((1, 0), (0, -1), (-1, 0), (0, 1)):
+            slot = DIRECTION_SLOTS[(dr, dc)]
+            table = array('i', bytes(4 * cellCount))
+
+            # Each cell is visited after the one it steps to
+            if dr + dc > 0:
+                order = range(cellCount - 1, -1, -1)
+            else:
+                order = range(cellCount)
+
+            for cell in order:
+                nextCell = neighbors[cell * 8 + slot]
+                if nextCell < 0:
+                    continue
+                r, c = divmod(nextCell, gridSize)
+                if self.hasForcedNeighbor(r, c, dr, dc):
+                    table[cell] = 1
+                elif table[nextCell] > 0:
+                    table[cell] = table[nextCell] + 1
+                else:
+                    table[cell] = table[nextCell] - 1
+
+            self.jumpTables[(dr, dc)] = table
+
+        self.jumpVersion = self.version
+
+    # Forced neighbor test for a straight run entering (r, c)
+    def hasForcedNeighbor(self, r, c, dr, dc):
+        isOpen = self.isOpen
+        if dc:
+            return (isOpen(r + 1, c + dc) and not isOpen(r + 1, c)) or (isOpen(r - 1, c + dc) and not isOpen(r - 1, c))
+        return (isOpen(r + dr, c + 1) and not isOpen(r, c + 1)) or (isOpen(r + dr, c - 1) and not isOpen(r, c - 1))
+
+    # Walkable test that treats cells outside the grid as blocked
+    def isOpen(self, r, c):
+        return 0 <= r < self.gridSize and 0 <= c < self.gridSize and self.walkable[r * self.gridSize + c] == 1
+
+    # Find a path between two world points, returns
+    # the world x, y of each cell center along it
+    def findPathWorld(self, startPos, goalPos):
+        path = self.findPath(self.cellAt(startPos[0], startPos[1]), self.cellAt(goalPos[0], goalPos[1]))
+        return [self.cellCenter(cell) for cell in path]
+
+    # Find paths for a batch of (start, goal) cell pairs in one call,
+    # returns one path per pair in order, repeated pairs are only
+    # planned once and the batch is spread over the worker pool
+    # when one was started
+    def findPaths(self, pairs):
+        pairs = [(tuple(start), tuple(goal)) for start, goal in pairs]
+        unique = list(dict.fromkeys(pairs))
+
+        if self.pool == None or len(unique) <= BATCH_CHUNK:
+            paths = [self.findPath(start, goal) for start, goal in unique]
+        else:
+            chunks = [unique[i:i + BATCH_CHUNK] for i in range(0, len(unique), BATCH_CHUNK)]
+            paths = chain.from_iterable(self.pool.map(findPathChunk, chunks))
+
+        # Every pair gets its own list, callers may consume them
+        found = dict(zip(unique, paths))
+        return [list(found[pair]) for pair in pairs]
+
+    # Batch version of findPathWorld
+    def findPathsWorld(self, pairs):
+        cellPairs = [(self.cellAt(start[0], start[1]), self.cellAt(goal[0], goal[1])) for start, goal in pairs]
+        return [[self.cellCenter(cell) for cell in path] for path in self.findPaths(cellPairs)]
+
+    # Start worker processes that each keep a copy of the grid and
+    # their own scratch buffers, used by findPaths until stopWorkers(),
+    # the copies do not see later changes to this grid
+    def startWorkers(self, count = None):
+        self.stopWorkers()
+        self.poolSize = count
+        # Views of a memory-mapped grid are copied for the workers
+        neighbors = self.neighbors
+        walkable = self.walkable
+        if not(self.mapping == None):
+            neighbors = array('i', neighbors)
+            walkable = bytearray(walkable)
+        self.pool = ProcessPoolExecutor(count, initializer = initPathWorker,
+                                        initargs = (self.gridSize, neighbors, walkable, self.originX,
+                                                    self.originY, self.cellLength, self.cellWidth, self.jumpPoints))
+
+    def stopWorkers(self):
+        if not(self.pool == None):
+            self.pool.shutdown()
+            self.pool = None
+
+    # Id for a new search, the scratch buffers are cleared
+    # once when the ids wrap around
+    def nextSearchId(self):
+        self.searchId = self.searchId + 1
+        if self.searchId > 2147483647:
+            self.searchId = 1
+            self.stamp = array('i', bytes(len(self.stamp) * 4))
+            self.closed = array('i', bytes(len(self.closed) * 4))
+        return self.searchId
+
+    def inGrid(self, cell):
+        return 0 <= cell[0] < self.gridSize and 0 <= cell[1] < self.gridSize
+
+    # Walk the parent links back from cell to the start
+    def tracePath(self, cell):
+        gridSize = self.gridSize
+        path = []
+        while cell >= 0:
+            path.append(divmod(cell, gridSize))
+            cell = self.parent[cell]
+        path.reverse()
+        return path
+
+    # Walk the parent links back from cell to the start,
+    # filling in the cells of each straight or diagonal jump
+    def traceJumps(self, cell):
+        gridSize = self.gridSize
+        path = []
+        while cell >= 0:
+            r, c = divmod(cell, gridSize)
+            path.append((r, c))
+            prev = self.parent[cell]
+            if prev >= 0:
+                pr, pc = divmod(prev, gridSize)
+                dr = (pr > r) - (pr < r)
+                dc = (pc > c) - (pc < c)
+                r, c = r + dr, c + dc
+                while not(r == pr and c == pc):
+                    path.append((r, c))
+                    r, c = r + dr, c + dc
+            cell = prev
+        path.reverse()
+        return path
+
+
+# Grid copy of a findPaths worker process
+workerFinder = None
+
+# Worker process initializer, builds the grid copy once
+def initPathWorker(gridSize, neighbors, walkable, originX, originY, cellLength, cellWidth, jumpPoints):
+    global workerFinder
+    workerFinder = PathFinder(gridSize, neighbors, originX, originY, cellLength, cellWidth)
+    workerFinder.walkable = walkable
+    workerFinder.jumpPoints = jumpPoints
+
+# Worker process entry point, plans one chunk of findPaths queries
+def findPathChunk(pairs):
+    return [workerFinder.findPath(start, goal) for start, goal in pairs]
@@ -0,0 +1,47 @@
+from panda3d.core import NodePath
+
+
+class WallBatch():
+    # Static walls placed from a single loaded wall model, the walls of
+    # each addWalls call are copied under one node and flattened into a
+    # few geoms, so a level of walls renders in a few draw calls
+    # the AI still needs one node per wall for its obstacle bounds, those
+    # are hidden instances of the model that share its geometry
+    def __init__(self, wallModel, parent, scale = 10):
+        # Model nodes would stop the copies from being merged
+        self.wallModel = wallModel.copyTo(NodePath("wall_model"))
+        self.wallModel.clearModelNodes()
+        self.wallModel.flattenStrong()
+        self.scale = scale
+
+        self.root = parent.attachNewNode("wall_batch")
+        self.obstacleRoot = parent.attachNewNode("wall_obstacles")
+        self.obstacleRoot.hide()
+
+        # Obstacle node of every wall, in the order they were added
+        self.obstacles = []
+
+    # Place walls at (x, y) positions, returns their obstacle nodes
+    def addWalls(self, positions):
+        batch = self.root.attachNewNode("walls")
+        added = []
+        for x, y in positions:
+            wall = self.wallModel.copyTo(batch)
+            wall.setPos(x, y, 0)
+            wall.setScale(self.scale)
+
+            obstacle = self.obstacleRoot.attachNewNode("wall")
+            obstacle.setPos(x, y, 0)
+            obstacle.setScale(self.scale)
+            self.wallModel.instanceTo(obstacle)
+            added.append(obstacle)
+
+        # Only the new walls are flattened, earlier batches stay as they are
+        batch.flattenStrong()
+        self.obstacles.extend(added)
+        return added
+
+    # Register obstacle nodes with PandAI in one pass
+    def registerObstacles(self, behaviors, obstacles):
+        for obstacle in obstacles:
+            behaviors.addStaticObstacle(obstacle)
@@ -0,0 +1,133 @@
+# Binary wall layouts, an 8 byte little endian header (magic, format
+# version, flags) followed by one int32 x, y record per wall, walls
+# are only ever appended so adding one never rewrites the file
+# usage: python WallLayout.py <wall_positions.txt> <wall_positions.walls>
+
+import os
+import struct
+import sys
+
+WALL_MAGIC = b'PWAL'
+WALL_VERSION = 1
+WALL_HEADER = struct.Struct('<4sHH')
+WALL_RECORD = struct.Struct('<ii')
+
+# Records read at a time by the streaming reader
+READ_CHUNK = 4096
+
+
+class WallLayout():
+    # A wall layout file, binary layouts are appended to in place and
+    # read back a chunk at a time, the x,y text layouts of older
+    # versions are still read (see convertText to turn them binary)
+    def __init__(self, filename = 'wall_positions.walls'):
+        self.filename = filename
+
+        # Kept open in append mode after the first append
+        self.file = None
+
+    # Start a new binary layout file with a header and no walls
+    @classmethod
+    def create(cls, filename = 'wall_positions.walls'):
+        with open(filename, 'wb') as file:
+            file.write(WALL_HEADER.pack(WALL_MAGIC, WALL_VERSION, 0))
+        return cls(filename)
+
+    # Turn a text layout into a binary one, streamed line by line
+    @classmethod
+    def convertText(cls, textFilename, filename = 'wall_positions.walls'):
+        layout = cls.create(filename)
+        layout.appendWalls(cls(textFilename).iterPositions())
+        layout.close()
+        return layout
+
+    # Add one wall at the end of the layout
+    def append(self, x, y):
+        self.appendWalls(((x, y),))
+
+    # Add walls from an iterable of (x, y) at the end of the layout
+    def appendWalls(self, positions):
+        if self.file == None:
+            self.openForAppend()
+
+        records = bytearray()
+        for x, y in positions:
+            records += WALL_RECORD.pack(int(x), int(y))
+            if len(records) >= WALL_RECORD.size * READ_CHUNK:
+                self.file.write(records)
+                records = bytearray()
+        self.file.write(records)
+        self.file.flush()
+
+    def openForAppend(self):
+        if not os.path.isfile(self.filename):
+            WallLayout.create(self.filename)
+        self.checkHeader(self.filename)
+
+        self.file = open(self.filename, 'ab')
+        # Drop a record left half written by an interrupted append
+        partial = (self.file.tell() - WALL_HEADER.size) % WALL_RECORD.size
+        if partial > 0:
+            self.file.truncate(self.file.tell() - partial)
+            self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if not(self.file == None):
+            self.file.close()
+            self.file = None
+
+    # True when filename starts with the binary layout magic
+    def isBinary(self, filename):
+        with open(filename, 'rb') as file:
+            return file.read(len(WALL_MAGIC)) == WALL_MAGIC
+
+    def checkHeader(self, filename):
+        with open(filename, 'rb') as file:
+            header = file.read(WALL_HEADER.size)
+        if len(header) < WALL_HEADER.size:
+            raise ValueError(filename + ' is not a version ' + str(WALL_VERSION) + ' wall layout')
+
+        magic, version, flags = WALL_HEADER.unpack(header)
+        if not(magic == WALL_MAGIC and version == WALL_VERSION):
+            raise ValueError(filename + ' is not a version ' + str(WALL_VERSION) + ' wall layout')
+
+    # Yield the (x, y) of every wall without reading the whole file,
+    # lines of a text layout that do not parse are skipped
+    def iterPositions(self):
+        if not self.isBinary(self.filename):
+            yield from self.iterTextPositions()
+            return
+
+        self.checkHeader(self.filename)
+        with open(self.filename, 'rb') as file:
+            file.seek(WALL_HEADER.size)
+            while True:
+                chunk = file.read(WALL_RECORD.size * READ_CHUNK)
+                # A half written last record is left out
+                whole = len(chunk) - len(chunk) % WALL_RECORD.size
+                yield from WALL_RECORD.iter_unpack(memoryview(chunk)[:whole])
+                if len(chunk) < WALL_RECORD.size * READ_CHUNK:
+                    break
+
+    def iterTextPositions(self):
+        with open(self.filename, 'r') as file:
+            for line in file:
+                parts = line.split(',')
+                try:
+                    yield (int(parts[0]), int(parts[1]))
+                except (ValueError, IndexError):
+                    if len(line.strip()) > 0:
+                        print('Invalid static level wall position, continuing..')
+
+    # All wall positions as a list of (x, y)
+    def readPositions(self):
+        return list(self.iterPositions())
+
+
+if __name__ == '__main__':
+    if not(len(sys.argv) == 3):
+        print('usage: python WallLayout.py <wall_positions.txt> <wall_positions.walls>')
+        sys.exit(1)
+
+    layout = WallLayout.convertText(sys.argv[1], sys.argv[2])
+    print('Converted ' + str(len(layout.readPositions())) + ' walls to ' + sys.argv[2])
@@ -0,0 +1,82 @@
+from array import array
+
+import numpy
+
+
+class WallRasterizer():
+    # Turns a list of wall placements into a blocked cell mask for a
+    # navmesh grid in one vectorized pass, every wall is the X/Y bounds
+    # of the wall model scaled and moved to its position, and blocks the
+    # cells it overlaps like NavMeshGenerator.addObstacle would
+    # the mask is a (gridSize, gridSize) bool array indexed [row][col],
+    # the form NavMeshGenerator.fromGrid takes as blocked
+    # placement is (originX, originY, cellLength, cellWidth) of the
+    # grid, as returned by NavMeshGenerator.gridPlacement()
+    def __init__(self, gridSize, placement = (0.0, 0.0, 1.0, 1.0), wallMin = (-0.5, -0.5), wallMax = (0.5, 0.5)):
+        self.gridSize = gridSize
+        self.originX, self.originY, self.cellLength, self.cellWidth = placement
+
+        # Wall model bounds at a scale of 1
+        self.wallMin = wallMin
+        self.wallMax = wallMax
+
+    # Rasterize onto the grid of a navmesh, with the
+    # wall bounds taken from a loaded wall model
+    @classmethod
+    def fromNavMesh(cls, navmesh, wallModel):
+        if not navmesh.ensureGrid():
+            raise ValueError('navmesh has no grid in memory to rasterize walls onto')
+
+        bounds = wallModel.getTightBounds()
+        return cls(len(navmesh.finalList), navmesh.gridPlacement(), (bounds[0].x, bounds[0].y), (bounds[1].x, bounds[1].y))
+
+    # Blocked cell mask of walls at positions, an (N, 2) array or list
+    # of x, y pairs, wallScale is one scale for all walls or one per wall
+    def rasterize(self, positions, wallScale = 10):
+        gridSize = self.gridSize
+        mask = numpy.zeros((gridSize, gridSize), dtype = bool)
+        positions = numpy.asarray(positions, dtype = numpy.float64).reshape(-1, 2)
+        if len(positions) == 0:
+            return mask
+
+        # Cell ranges of every wall, the same rounding as cellsInBounds
+        wallScale = numpy.asarray(wallScale, dtype = numpy.float64)
+        x = positions[:, 0] - self.originX
+        y = positions[:, 1] - self.originY
+        c0 = numpy.floor((x + self.wallMin[0] * wallScale) / self.cellLength)
+        c1 = numpy.ceil((x + self.wallMax[0] * wallScale) / self.cellLength)
+        r0 = numpy.floor((y + self.wallMin[1] * wallScale) / self.cellWidth)
+        r1 = numpy.ceil((y + self.wallMax[1] * wallScale) / self.cellWidth)
+        c0, c1, r0, r1 = [numpy.clip(edge, 0, gridSize).astype(numpy.int64) for edge in (c0, c1, r0, r1)]
+
+        # Walls off the grid cover no cells
+        inside = (c0 < c1) & (r0 < r1)
+        c0, c1, r0, r1 = c0[inside], c1[inside], r0[inside], r1[inside]
+
+        # Mark the corners of every wall rectangle in a 2D difference
+        # array, the running sums along both axes then count the walls
+        # over each cell, however many cells each wall covers
+        counts = numpy.zeros((gridSize + 1, gridSize + 1), dtype = numpy.int32)
+        numpy.add.at(counts, (r0, c0), 1)
+        numpy.add.at(counts, (r0, c1), -1)
+        numpy.add.at(counts, (r1, c0), -1)
+        numpy.add.at(counts, (r1, c1), 1)
+        counts = counts.cumsum(axis = 0).cumsum(axis = 1)
+
+        mask[:] = counts[:gridSize, :gridSize] > 0
+        return mask
+
+    # (row, col) of every blocked cell, for NavMeshGenerator.setCellsBlocked
+    def cells(self, mask):
+        rows, cols = numpy.nonzero(mask)
+        return list(zip(rows.tolist(), cols.tolist()))
+
+    # Flat quad array of the open cells, the Coll side NavMeshGenerator
+    # takes next to a full grid (see EggPrimitiveCreation.makeSquaresQuads)
+    def collQuads(self, mask):
+        rows, cols = numpy.nonzero(~mask)
+        x0 = self.originX + cols * self.cellLength
+        z0 = self.originY + rows * self.cellWidth
+        x1 = x0 + self.cellLength
+        z1 = z0 + self.cellWidth
+        return array('d', numpy.stack((x0, x1, x1, x0, z0, z0, z1, z1), axis = 1).ravel().tolist())
@@ -16,7 +16,18 @@ from direct.gui.OnscreenText import OnscreenText
 
 from panda3d.ai import *
 from NavMeshGenerator import *
+from NavMeshCache import NavMeshCache
 import EggPrimitiveCreation
+from WallBatch import WallBatch
+from WallLayout import WallLayout
+from AgentSync import AgentSync
+
+# NumPy is optional, without it walls are added
+# to the navmesh one at a time
+try:
+    from WallRasterizer import WallRasterizer
+except ImportError:
+    WallRasterizer = None
 
 import complexpbr
 # import pandarecord
@@ -32,9 +43,7 @@ load_prc_file_data("", """
 """)
 
 
-ShowBase()
 speed = 10.0
-font = base.loader.loadFont("cmss12")
 
 # Function to put instructions on the screen.
 def addInstructions(pos, msg):
@@ -84,9 +93,17 @@ class World:
         self.pointer_move = False
         self.loadModels()
         self.aiObstacleList = []
+        # saved walls, opened by the first wall added this session
+        self.wallLayout = None
+
+        # create built-in collision from loaded model, the terrain is
+        # also hashed into a height sampler for ground following
+        collision_root = EggPrimitiveCreation.makeCollisionModel("environ_1.bam", heightNodeName="Plane.001")
+        self.heightSampler = collision_root.getPythonTag("heightSampler")
 
-        # create built-in collision from loaded model
-        EggPrimitiveCreation.makeCollisionModel("environ_1.bam")
+        # keeps the visible actors on the terrain under their AI nodes
+        self.agentSync = AgentSync(self.heightSampler)
+        self.agentSync.addAgent(self.ralph, self.ralphVis)
         
         # create a box primitive for obstacle placement
         new_wall = loader.loadModel("models/wall_test.glb")
@@ -148,12 +165,9 @@ class World:
         # ralphStartPos = self.environ.find("**/start_point").getPos()
         ralphStartPos = Vec3(20, 20, 0)
 
-        self.ralph = Actor("models/ralph",
-                           {"run": "models/ralph-run",
-                            "walk": "models/ralph-walk"})
-
-        self.ralph.reparentTo(render)
-        self.ralph.setScale(2)
+        # the AI drives a plain node, the visible actor follows its
+        # position and heading, kept level on the terrain (see AgentSync)
+        self.ralph = render.attachNewNode("ralph")
         self.ralph.setPos(ralphStartPos)
 
         self.ralphVis = Actor("models/ralph",
@@ -194,29 +208,42 @@ class World:
         self.AIbehaviors = self.AIchar.getAiBehaviors()
 
         # the following loads in a "navmesh" .csv file
-        # generated using an .egg primitive created on the fly
-        # with built-in panda3d functions and some boutique
-        # PandAI specific formatting for the 2D A* system
-        prim_1_name = "squares"  # this is the navmesh primitive
-        prim_2_name = "squares_coll"  # this is a copy of the navmesh primitive
-        # we begin by making two meshes, one "Full" and one "Coll"
-        # in order to build the 2D navigation mesh from .egg files
-        primitive_data_1 = EggPrimitiveCreation.makeSquaresEVPXZ(30, 30, 10, "Full",0)
-        primitive_data_2 = EggPrimitiveCreation.makeSquaresEVPXZ(30, 30, 10, "Coll",0)
+        # generated from a grid description on the fly
+        # with some boutique PandAI specific formatting
+        # for the 2D A* system
+        # a 30x30 grid of 10 unit cells is converted directly
+        # to the 2D A* pathfinding system and reused from the
+        # navmesh cache on later launches, the cells take their
+        # heights from the terrain and too steep cells are blocked
+        self.navmesh = NavMeshGenerator.fromGrid(30, 10, cache=NavMeshCache(), terrain=self.heightSampler)
+
+        # the wall model is loaded once, walls are placed as
+        # flattened batches of copies of it, and wall placements
+        # are rasterized onto the same grid so a whole level
+        # of walls is a single navmesh update
+        wall_model = loader.loadModel("models/wall_test.bam")
+        self.wallBatch = WallBatch(wall_model, render, 10)
+        self.wallRasterizer = None
+        if not(WallRasterizer == None):
+            self.wallRasterizer = WallRasterizer.fromNavMesh(self.navmesh, wall_model)
+
+        # alternatively, we can make two meshes, one "Full" and one "Coll"
+        # and build the 2D navigation mesh from in-memory .egg data
+        # primitive_data_1 = EggPrimitiveCreation.makeSquaresEVPXZ(30, 30, 10, "Full",0)
         # primitive_data_2 = EggPrimitiveCreation.makeSquaresEVPXZSparse(30, 30, 10, "Coll",0)
-        primitive_data_1.writeEgg(Filename(prim_1_name + ".egg"))
-        primitive_data_2.writeEgg(Filename(prim_2_name + ".egg"))
-
-        # now we'll take these .egg files generated on the fly
-        # and convert them to the 2D A* pathfinding system
-        navmesh = NavMeshGenerator(prim_1_name + ".egg", prim_2_name + ".egg")
+        # self.navmesh = NavMeshGenerator(primitive_data_1, primitive_data_2)
+        # or skip the egg objects and hand over flat quad arrays
+        # sparse_squares = [(10, y) for y in range(30)] + [(x, 10) for x in range(30)]
+        # self.navmesh = NavMeshGenerator(EggPrimitiveCreation.makeSquaresQuads(30, 30, 10),
+        #                                 EggPrimitiveCreation.makeSquaresQuads(30, 30, 10, sparse_squares))
         # the navmesh has now been automatically created
         # and we can add it to the PandAI init_path_find()
         self.AIbehaviors.initPathFind("navmesh.csv")
         # self.AIbehaviors.initPathFind("models/navmesh.csv")
 
         # visually verify generated .egg files
-        # egg_1 = loader.loadModel(prim_2_name + ".egg")
+        # primitive_data_2.writeEgg(Filename("squares_coll.egg"))
+        # egg_1 = loader.loadModel("squares_coll.egg")
         # egg_1.reparentTo(base.render)
         # egg_1.setShaderOff()
 
@@ -241,9 +268,35 @@ class World:
         self.AIbehaviors.pathFindTo(self.pointer, "somePath")
         # self.AIbehaviors.seek(self.pointer)
         self.ralphVis.loop("run")
-        self.ralph.hide()
 
     def move(self):
+        # without NumPy there is no height sampler and the
+        # ground rays are traversed every frame instead
+        if self.heightSampler == None:
+            self.followGroundRays()
+        else:
+            self.followHeightSampler()
+
+        # print(base.cam.getP())
+        
+        return Task.cont
+
+    def followHeightSampler(self):
+        # adjust the Z coordinate of every AI character
+        # in one batch, ralph's included
+        self.agentSync.update()
+
+        # keep the camera at one unit above the terrain,
+        # or two units above ralph, whichever is greater.
+        camZ = self.heightSampler.heightAt(base.camera.getX(), base.camera.getY())
+        if not(camZ == None):
+            base.camera.setZ(camZ + 1.5)
+        if base.camera.getZ() < self.ralphVis.getZ(render) + 2.0:
+            base.camera.setZ(self.ralphVis.getZ(render) + 2.0)
+
+    def followGroundRays(self):
+        # move ralph with his AI node, kept level
+        self.agentSync.update()
         self.cTrav.traverse(render)
 
         # adjust ralph's Z coordinate
@@ -255,7 +308,7 @@ class World:
             # discover what the collision node entry names are if we don't know already
             # print(entry.getIntoNode().name)
             if entry.getIntoNode().name == "Plane.001":
-                self.ralphVis.setZ(entry.getSurfacePoint(render).getZ())
+                self.ralphVis.setZ(render, entry.getSurfacePoint(render).getZ())
 
         # keep the camera at one unit above the terrain,
         # or two units above ralph, whichever is greater.
@@ -265,79 +318,68 @@ class World:
         for entry in entries:
             if entry.getIntoNode().name == "Plane.001":
                 base.camera.setZ(entry.getSurfacePoint(render).getZ() + 1.5)
-        if base.camera.getZ() < self.ralphVis.getZ() + 2.0:
-            base.camera.setZ(self.ralphVis.getZ() + 2.0)
-
-        # self.ralphVis.setP(0)
-        self.ralphVis.setX(self.ralph.getX())
-        self.ralphVis.setY(self.ralph.getY())
-        self.ralphVis.setH(self.ralph.getH())
-        # print(base.cam.getP())
-        
-        return Task.cont
+        if base.camera.getZ() < self.ralphVis.getZ(render) + 2.0:
+            base.camera.setZ(self.ralphVis.getZ(render) + 2.0)
         
     def initializeStaticLevelWalls(self):
-        new_wall = loader.loadModel("models/wall_test.bam")
-        new_wall.setPos(0,0,0)
-        new_wall.setScale(10)
-        new_wall.reparentTo(render)
-        self.AIbehaviors.addStaticObstacle(new_wall)
+        new_walls = self.addLevelWalls([(0, 0)])
 
-        new_wall_ref = ['new_wall', self.pointer.getPos(), new_wall.getScale().x]
+        new_wall_ref = ['new_wall', self.pointer.getPos(), new_walls[0].getScale().x]
         self.aiObstacleList.append(new_wall_ref)
         
     def addStaticLevelWalls(self):
-        new_wall = loader.loadModel("models/wall_test.bam")
         # print(self.pointer.getPos())
-        new_wall.setPos(self.pointer.getPos())
-        new_wall.setScale(10)
-        new_wall.reparentTo(render)
-        self.AIbehaviors.addStaticObstacle(new_wall)
+        new_walls = self.addLevelWalls([(self.pointer.getX(), self.pointer.getY())])
 
-        new_wall_ref = ['new_wall', self.pointer.getPos(), new_wall.getScale().x]
+        new_wall_ref = ['new_wall', self.pointer.getPos(), new_walls[0].getScale().x]
         self.aiObstacleList.append(new_wall_ref)
         
-        with open('wall_positions.txt','w') as out_v:
-            for item in self.aiObstacleList:
-                # print(item[1])
-                out_v.write(str(int(item[1].x)) + ',' + str(int(item[1].y)) + '\n')
-
-        out_v.close()
+        # the first wall of a session starts a new layout with every
+        # wall so far, later walls are appended without a rewrite
+        if self.wallLayout == None:
+            self.wallLayout = WallLayout.create('wall_positions.walls')
+            self.wallLayout.appendWalls([(item[1].x, item[1].y) for item in self.aiObstacleList])
+        else:
+            self.wallLayout.append(self.pointer.getX(), self.pointer.getY())
         
     def loadDefaultLevelWalls(self):
-        wall_list = open('models/default_wall_positions.txt', 'r')
-        wall_list = wall_list.read()
-
-        for wall in wall_list.split('\n'):
-            new_wall = loader.loadModel("models/wall_test.bam")
-
-            wall_positions = wall.split(',')
-            try:
-                # print(wall_positions[0], wall_positions[1])
-                new_wall.setPos(int(wall_positions[0]), int(wall_positions[1]), 0)
-                new_wall.setScale(10)
-
-                new_wall.reparentTo(render)
-                self.AIbehaviors.addStaticObstacle(new_wall)
-            except:
-                print('Invalid static level wall position, continuing..')
+        self.addLevelWalls(WallLayout('models/default_wall_positions.txt').readPositions())
         
     def loadStaticLevelWalls(self): 
-        wall_list = open('wall_positions.txt', 'r')
-        wall_list = wall_list.read()
-
-        for wall in wall_list.split('\n'):
-            new_wall = loader.loadModel("models/wall_test.bam")
-
-            wall_positions = wall.split(',')
-            try:
-                # print(wall_positions[0], wall_positions[1])
-                new_wall.setPos(int(wall_positions[0]), int(wall_positions[1]), 0)
-                new_wall.setScale(10)
-                new_wall.reparentTo(render)
-                self.AIbehaviors.addStaticObstacle(new_wall)
-            except:
-                print('Invalid static level wall position, continuing..')
+        # layouts saved as text by older versions are converted once
+        if not os.path.isfile('wall_positions.walls') and os.path.isfile('wall_positions.txt'):
+            WallLayout.convertText('wall_positions.txt', 'wall_positions.walls')
+        self.addLevelWalls(WallLayout('wall_positions.walls').readPositions())
+
+    def addLevelWalls(self, positions):
+        # place walls at (x, y) positions in one batch, they are
+        # registered as PandAI obstacles and blocked on the navmesh
+        # together, returns their obstacle nodes
+        new_walls = self.wallBatch.addWalls(positions)
+        self.wallBatch.registerObstacles(self.AIbehaviors, new_walls)
+        self.addWallsToNavMesh(new_walls)
+        return new_walls
+
+    def addWallToNavMesh(self, wall):
+        # block the navmesh cells under the wall, only the
+        # affected rows of navmesh.csv are rewritten
+        bounds = wall.getTightBounds(render)
+        if bounds:
+            self.navmesh.addObstacle(bounds[0].x, bounds[0].y, bounds[1].x, bounds[1].y)
+
+    def addWallsToNavMesh(self, walls):
+        # block the navmesh cells under many walls at once, the
+        # walls are rasterized in one pass and the navmesh is
+        # updated once instead of once per wall
+        if self.wallRasterizer == None:
+            for wall in walls:
+                self.addWallToNavMesh(wall)
+            return
+
+        positions = [(wall.getX(render), wall.getY(render)) for wall in walls]
+        scales = [wall.getScale(render).x for wall in walls]
+        mask = self.wallRasterizer.rasterize(positions, scales)
+        self.navmesh.setCellsBlocked(self.wallRasterizer.cells(mask))
 
     def resetCamPos(self):
         base.cam.setPos(self.camPositions[0])
@@ -378,5 +420,10 @@ class World:
         return Task.again
 
 
-w = World()
-base.run()
+# the navmesh worker processes import this module again,
+# only the process that was launched opens the window
+if __name__ == "__main__":
+    ShowBase()
+    font = base.loader.loadFont("cmss12")
+    w = World()
+    base.run()